@@ -0,0 +1,33 @@
+"""
+Optional numba compilation.
+
+If numba is not installed, njit returns the undecorated python function,
+which gives the same results much more slowly. The model functions
+therefore skip their compiled loops without numba, and evaluate the
+plain-arithmetic _point functions on whole arrays instead.
+"""
+import numpy as np
+
+try:
+    import numba
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+def njit(*args, **kwargs):
+    """
+    numba.njit, or a decorator that does nothing if numba is not installed.
+    """
+    if HAS_NUMBA:
+        return numba.njit(*args, **kwargs)
+    if len(args) == 1 and callable(args[0]) and not kwargs:
+        return args[0]
+    return lambda f: f
+
+def vectorize(*args, **kwargs):
+    """
+    numba.vectorize, or np.vectorize with float64 output if numba is not installed.
+    """
+    if HAS_NUMBA:
+        return numba.vectorize(*args, **kwargs)
+    return lambda f: np.vectorize(f, otypes=[np.float64])
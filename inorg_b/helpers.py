@@ -1,13 +1,55 @@
-from pandas import IndexSlice as idx
-import uncertainties.unumpy as up
+from collections import namedtuple
 import numpy as np
+import numexpr as ne
+from ._njit import HAS_NUMBA, njit, vectorize
+
+# natural log of 10, so 10**x can be calculated as exp(LN10 * x)
+LN10 = 2.302585092994046
 
 def err(x):
-    return up.std_devs(x)
+    """
+    Return the uncertainties of x.
+
+    x may be a uarray, or float values (e.g. an '_eprop' column), which
+    already are uncertainties and are returned unchanged as a float array.
+    """
+    x = np.asarray(x)
+    if x.dtype == object:
+        # uarrays are only produced outside this package, so import on demand
+        import uncertainties.unumpy as up
+        return up.std_devs(x)
+    return x.astype(np.float64, copy=False)
 
 def nom(x):
+    """
+    Return the nominal values of a uarray.
+
+    Float input is not accepted: measured values are stored in the plain
+    measurement columns, and their uncertainties in the '_eprop' columns.
+    """
+    x = np.asarray(x)
+    if x.dtype != object:
+        raise TypeError('nom() expects a uarray. Nominal values are stored in the '
+                        "measurement columns, and uncertainties in the '_eprop' columns.")
+    import uncertainties.unumpy as up
     return up.nominal_values(x)
 
+def _f(x):
+    """
+    Return x as a float64 numpy array, without copying if it already is one.
+    """
+    return x.to_numpy(dtype=np.float64, copy=False)
+
+def sort_axes(df):
+    """
+    Sort a DataFrame by its index and columns, skipping axes that are already sorted.
+    """
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index(axis=0)
+    if not df.columns.is_monotonic_increasing:
+        df = df.sort_index(axis=1)
+    return df
+
 def sol_B_iso(BT, BO4, d11B_total, alpha=1.026):
     """
     Calculate d11B of aqueous species.
@@ -24,42 +66,156 @@ def sol_B_iso(BT, BO4, d11B_total, alpha=1.026):
 
     return d11BO4, d11BO3
 
-def sol_B_iso_Rae2018(pH, BO4, BT, alpha, d11BT):
+# closed-form solution for R11 of BO4 in sol_B_iso_Rae2018, converted straight to
+# d11BO4 so the whole calculation is a single numexpr pass.
+# RB4 is the positive root of alpha*(H + Kb)*RB4**2 - b*RB4 - (H + Kb)*R_BT = 0, with
+# b = R_BT*(H + Kb*alpha) - H*alpha - Kb
+_b_EXPR = "(R_BT*(Hval + Kbval*alpha) - Hval*alpha - Kbval)"
+_RB4_EXPR = ("((" + _b_EXPR + " + sqrt(" + _b_EXPR + "**2 + 4*alpha*(Hval + Kbval)**2*R_BT))"
+             "/(2*alpha*(Hval + Kbval)))")
+_d11BO4_EXPR = "(" + _RB4_EXPR + " / SRM_ratio - 1) * 1000"
+
+def _precompute_HK(pH, BT, BO4):
+    """
+    Calculate [H+] and the apparent borate dissociation constant.
+
+    Returns
+    -------
+    Hval, Kbval
+    """
+    pH, BT, BO4 = (np.asarray(v, dtype=np.float64) for v in (pH, BT, BO4))
+
+    Hval = np.exp(-LN10 * pH)
+    Kbval = BO4 * Hval / (BT - BO4)
+    return Hval, Kbval
+
+def _solve_d11BO4(Hval, Kbval, d11BT, alpha, SRM_ratio=4.04367):
+    """
+    Solve the Rae (2018) mass balance for d11B of BO4 and BO3.
+
+    Returns
+    -------
+    d11BO4, d11BO3
+    """
+    R_BT = d11_2_R11(np.asarray(d11BT, dtype=np.float64), SRM_ratio)
+    d11BO4 = ne.evaluate(_d11BO4_EXPR, local_dict={'Hval': Hval, 'Kbval': Kbval, 'R_BT': R_BT,
+                                                   'alpha': alpha, 'SRM_ratio': SRM_ratio})
+    # RB3 = RB4 * alpha, in delta notation
+    d11BO3 = alpha * (d11BO4 + 1000) - 1000
+
+    return d11BO4, d11BO3
+
+def _solve_d11BO4_err(Hval, Kbval, d11BT, d11BT_err, alpha, SRM_ratio=4.04367):
+    """
+    Propagate the uncertainty in d11BT through _solve_d11BO4.
+
+    Returns
+    -------
+    d11BO4_err, d11BO3_err
+    """
+    R_BT = d11_2_R11(np.asarray(d11BT, dtype=np.float64), SRM_ratio)
+    # derivative of the root in _RB4_EXPR w.r.t. R_BT
+    S = Hval + Kbval
+    db = Hval + Kbval*alpha
+    b = R_BT*db - Hval*alpha - Kbval
+    dRB4 = (db + (b*db + 2*alpha*S**2) / np.sqrt(b**2 + 4*alpha*S**2*R_BT)) / (2*alpha*S)
+
+    # the SRM ratio cancels when converting the derivative to delta notation
+    d11BO4_err = abs(dRB4) * np.asarray(d11BT_err, dtype=np.float64)
+    return d11BO4_err, d11BO4_err * alpha
+
+def sol_B_iso_Rae2018(pH, BO4, BT, alpha, d11BT, SRM_ratio=4.04367):
     """
     Calculate d11B of aqueous species using full mass-balance approach of Rae, 2018.
+
+    Default SRM_ratio is NIST951 11B/10B
     
     Returns
     -------
     d11BO4, d11BO3
     """
+    Hval, Kbval = _precompute_HK(pH, BT, BO4)
+    return _solve_d11BO4(Hval, Kbval, d11BT, alpha, SRM_ratio)
 
-    R_BT = d11_2_R11(d11BT)
-    Hval = 10**(pH * -1)
-    Kbval = BO4 * Hval / (BT - BO4)
-    RB4 = (((Hval**2*R_BT**2 + 2*Hval**2*R_BT*alpha + Hval**2*alpha**2 + 2*Hval*Kbval*R_BT**2*alpha - 
-             2*Hval*Kbval*R_BT*alpha**2 + 8*Hval*Kbval*R_BT*alpha - 2*Hval*Kbval*R_BT + 2*Hval*Kbval*alpha + 
-             Kbval**2*R_BT**2*alpha**2 + 2*Kbval**2*R_BT*alpha + Kbval**2)**(1/2) - 
-            Hval*alpha - Kbval + Hval*R_BT + Kbval*R_BT*alpha)/(2*alpha*(Hval + Kbval)))
-    RB3 = RB4 * alpha
+def sol_B_iso_Rae2018_err(pH, BO4, BT, alpha, d11BT, d11BT_err, SRM_ratio=4.04367):
+    """
+    Propagate the uncertainty in d11BT through sol_B_iso_Rae2018.
 
-    # return RB4, RB3
-    return R11_2_d11(RB4), R11_2_d11(RB3)
+    pH, BO4 and BT are treated as exact.
+
+    Returns
+    -------
+    d11BO4_err, d11BO3_err
+    """
+    Hval, Kbval = _precompute_HK(pH, BT, BO4)
+    return _solve_d11BO4_err(Hval, Kbval, d11BT, d11BT_err, alpha, SRM_ratio)
 
 # Unit Converters
-def d11_2_A11(d11, SRM_ratio=4.04367):
+# NIST951 11B/10B, the default SRM_ratio of the unit converters
+NIST951 = 4.04367
+
+# Scalar unit converters, for use inside numba-compiled model functions.
+@njit(cache=True, fastmath=True, error_model="numpy")
+def _d11_2_A11(d11, SRM_ratio=NIST951):
+    return SRM_ratio * (d11 / 1000 + 1) / (SRM_ratio * (d11 / 1000 + 1) + 1)
+
+@njit(cache=True, fastmath=True, error_model="numpy")
+def _A11_2_d11(A11, SRM_ratio=NIST951):
+    return ((A11 / (1 - A11)) / SRM_ratio - 1) * 1000
+
+@njit(cache=True, fastmath=True, error_model="numpy")
+def _d11_2_R11(d11, SRM_ratio=NIST951):
+    return (d11/1000 + 1) * SRM_ratio
+
+@njit(cache=True, fastmath=True, error_model="numpy")
+def _R11_2_d11(R11, SRM_ratio=NIST951):
+    return (R11 / SRM_ratio - 1) * 1000
+
+# ufunc versions of the above with NIST951 compiled in, used by the public
+# converters for float inputs when SRM_ratio is the default.
+@vectorize(['f8(f8)'], cache=True, fastmath=True)
+def _d11_2_A11_NIST951(d11):
+    return _d11_2_A11(d11, NIST951)
+
+@vectorize(['f8(f8)'], cache=True, fastmath=True)
+def _A11_2_d11_NIST951(A11):
+    return _A11_2_d11(A11, NIST951)
+
+@vectorize(['f8(f8)'], cache=True, fastmath=True)
+def _d11_2_R11_NIST951(d11):
+    return _d11_2_R11(d11, NIST951)
+
+@vectorize(['f8(f8)'], cache=True, fastmath=True)
+def _R11_2_d11_NIST951(R11):
+    return _R11_2_d11(R11, NIST951)
+
+def _use_ufunc(x, SRM_ratio):
+    """
+    True if x can be passed to the compiled NIST951 ufuncs.
+
+    Other SRM ratios, object arrays (e.g. uarrays), and installs without numba
+    use the python expressions.
+    """
+    return HAS_NUMBA and SRM_ratio == NIST951 and np.asarray(x).dtype != object
+
+def d11_2_A11(d11, SRM_ratio=NIST951):
     """
     Convert Delta to Abundance notation.
 
     Default SRM_ratio is NIST951 11B/10B
     """
+    if _use_ufunc(d11, SRM_ratio):
+        return _d11_2_A11_NIST951(d11)
     return SRM_ratio * (d11 / 1000 + 1) / (SRM_ratio * (d11 / 1000 + 1) + 1)
 
-def A11_2_d11(A11, SRM_ratio=4.04367):
+def A11_2_d11(A11, SRM_ratio=NIST951):
     """
     Convert Abundance to Delta notation.
 
     Default SRM_ratio is NIST951 11B/10B
     """
+    if _use_ufunc(A11, SRM_ratio):
+        return _A11_2_d11_NIST951(A11)
     return ((A11 / (1 - A11)) / SRM_ratio - 1) * 1000
 
 def A11_2_R11(A11):
@@ -68,21 +224,25 @@ def A11_2_R11(A11):
     """
     return A11 / (1 - A11)
 
-def d11_2_R11(d11, SRM_ratio=4.04367):
+def d11_2_R11(d11, SRM_ratio=NIST951):
     """
     Convert Delta to isotope ratio notation.
 
     Default SRM_ratio is NIST951 11B/10B
     """
+    if _use_ufunc(d11, SRM_ratio):
+        return _d11_2_R11_NIST951(d11)
     return (d11/1000 + 1) * SRM_ratio
 
 
-def R11_2_d11(R11, SRM_ratio=4.04367):
+def R11_2_d11(R11, SRM_ratio=NIST951):
     """
     Convert isotope ratio to Delta notation.
 
     Default SRM_ratio is NIST951 11B/10B
     """
+    if _use_ufunc(R11, SRM_ratio):
+        return _R11_2_d11_NIST951(R11)
     return (R11 / SRM_ratio - 1) * 1000
 
 
@@ -92,48 +252,68 @@ def R11_2_A11(R11):
     """
     return R11 / (1 + R11)
 
+# the variables returned by extract_model_vars
+ModelVars = namedtuple('ModelVars', ['logRp', 'Rp', 'rL3', 'rL4', 'B_DIC', 'ABO3', 'ABO4', 'dBO4',
+                                     'LambdaB', 'EpsilonB', 'LambdaB_err', 'EpsilonB_err',
+                                     'LambdaB_err_norm', 'EpsilonB_err_norm'])
 
-
-def extract_model_vars(rd, exp='Uchikawa', Rvar=('Solid', 'logR'), phase='Calcite'):
+def extract_model_vars(rd, exp='Uchikawa', Rvar=('Solid', 'logR'), phase='Calcite', sub=None):
     """
+    Parameters
+    ----------
+    rd : pandas.DataFrame
+        Data created by load.processed().
+    exp, phase : str
+        The experiment and phase to extract.
+    Rvar : tuple
+        The precipitation rate column. Treated as log10 rates if its name contains 'log'.
+    sub : pandas.DataFrame
+        The rows of rd already selected by rd.xs((exp, phase), level=(1, 2)),
+        for callers that also need them. If given, rd is not searched again.
+
     Returns
     -------
+    ModelVars namedtuple of
     (logRp, Rp, rL3, rL4, B_DIC, ABO3, ABO4, dBO4, LambdaB, EpsilonB, 
      LambdaB_err, EpsilonB_err, LambdaB_err_norm, EpsilonB_err_norm)
+
+    Each is a contiguous row of a single float64 array.
     """
     # prepare fitting variables
-    cind = idx[:, exp, phase]
+    if sub is None:
+        sub = rd.xs((exp, phase), level=(1, 2))
+    v = ModelVars(*np.empty((len(ModelVars._fields), len(sub))))
 
     # Precipitation Rate
     if 'log' in Rvar[-1]:
-        logRp = (rd.loc[cind, Rvar]).values
-        Rp = 10**logRp
+        v.logRp[:] = _f(sub[Rvar])
+        np.exp(LN10 * v.logRp, out=v.Rp)
     else:
-        Rp = (rd.loc[cind, Rvar]).values
-        logRp = np.log10(Rp)
+        v.Rp[:] = _f(sub[Rvar])
+        np.log10(v.Rp, out=v.logRp)
 
     # Solution BO3/C and BO4/CO3 ratios
-    rL3 = (rd.loc[cind, ('pitzer', 'BOH3')] / rd.loc[cind, ('pitzer', 'C')]).astype(float).values
-    rL4 = (rd.loc[cind, ('pitzer', 'BOH4_free')] / rd.loc[cind, ('pitzer', 'CO3')]).astype(float).values
+    v.rL3[:] = _f(sub[('pitzer', 'BOH3')] / sub[('pitzer', 'C')])
+    v.rL4[:] = _f(sub[('pitzer', 'BOH4_free')] / sub[('pitzer', 'CO3')])
     # B/DIC for LambdaB calculation
-    B_DIC = (rd.loc[cind, ('pitzer', 'B')] / rd.loc[cind, ('pitzer', 'C')]).astype(float).values
+    v.B_DIC[:] = _f(sub[('pitzer', 'B')] / sub[('pitzer', 'C')])
+    # Borate d11B, also used for EpsilonB calculation
+    v.dBO4[:] = _f(sub[('Solution', 'd11BO4 (permil vs NIST951)')])
     # Isotopic content of each B species
-    ABO3 = d11_2_A11(rd.loc[cind, ('Solution', 'd11BO3 (permil vs NIST951)')].astype(float).values)
-    ABO4 = d11_2_A11(rd.loc[cind, ('Solution', 'd11BO4 (permil vs NIST951)')].astype(float).values)
-    # Borate d11B for EpsilonB calculation
-    dBO4 = rd.loc[cind, ('Solution', 'd11BO4 (permil vs NIST951)')].astype(float).values
+    v.ABO3[:] = d11_2_A11(_f(sub[('Solution', 'd11BO3 (permil vs NIST951)')]))
+    v.ABO4[:] = d11_2_A11(v.dBO4)
 
     # Measured LambdaB and EpsilonB fo residual calculation
-    LambdaB = rd.loc[cind, ('Solid', 'LambdaB')].astype(float).values
-    EpsilonB = rd.loc[cind, ('Solid', 'EpsilonB')].astype(float).values
+    v.LambdaB[:] = _f(sub[('Solid', 'LambdaB')])
+    v.EpsilonB[:] = _f(sub[('Solid', 'EpsilonB')])
 
     # Uncertainties on the measured variables
-    LambdaB_err = err(rd.loc[cind, ('Solid', 'LambdaB_eprop')].values)
-    EpsilonB_err = err(rd.loc[cind, ('Solid', 'EpsilonB_eprop')].values)
+    v.LambdaB_err[:] = _f(sub[('Solid', 'LambdaB_eprop')])
+    v.EpsilonB_err[:] = _f(sub[('Solid', 'EpsilonB_eprop')])
 
     # normalised to their mean, to make them comparable
-    LambdaB_err_norm = (LambdaB_err / LambdaB_err.mean())**0.5
-    EpsilonB_err_norm = (EpsilonB_err / EpsilonB_err.mean())**0.5
+    # (e / mean)**0.5 == sqrt(e) / sqrt(mean), so only the scalar mean needs a division
+    np.multiply(np.sqrt(v.LambdaB_err), 1 / np.sqrt(v.LambdaB_err.mean()), out=v.LambdaB_err_norm)
+    np.multiply(np.sqrt(v.EpsilonB_err), 1 / np.sqrt(v.EpsilonB_err.mean()), out=v.EpsilonB_err_norm)
 
-    return (logRp, Rp, rL3, rL4, B_DIC, ABO3, ABO4, dBO4, LambdaB, EpsilonB, 
-            LambdaB_err, EpsilonB_err, LambdaB_err_norm, EpsilonB_err_norm)
+    return v
@@ -1,47 +1,139 @@
+import numpy as np
 import pandas as pd
-from .helpers import sol_B_iso_Rae2018
+from .helpers import sort_axes, _precompute_HK, _solve_d11BO4, _solve_d11BO4_err
 from .phreeqpy_fns import calc_cb_rows
 
+import os
 import re
-import uncertainties.unumpy as un
+import time
+import warnings
 
+RAW_DATA_URL = 'https://docs.google.com/spreadsheets/d/e/2PACX-1vRo_UMyhlIlOpdYffTQMFlySTs8v1lnr1EZpsQBHATWrRBrNJG8CnCnGKJJbcrC6Vj7L9k3_Fy4WmT8/pub?gid=0&single=true&output=csv'
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'farmer2018')
 
-def raw_data():
+def _read_cache(cache):
     """
-    Load raw data from google sheet.
+    Read the cached raw data, or return None if it is missing or unreadable.
+    """
+    if not os.path.exists(cache):
+        return None
+    try:
+        return pd.read_pickle(cache)
+    except Exception as e:
+        # e.g. a cache written by a different pandas version
+        warnings.warn('Could not read cached raw data ({}), downloading again.'.format(e))
+        return None
+
+def _cache_expired(cache, max_age):
+    """
+    True if the cached raw data is more than max_age days old.
+    """
+    return (max_age is not None and os.path.exists(cache)
+            and time.time() - os.path.getmtime(cache) > max_age * 86400)
+
+def raw_data(use_cache=True, refresh=False, max_age=7):
     """
-    raw_data_url = 'https://docs.google.com/spreadsheets/d/e/2PACX-1vRo_UMyhlIlOpdYffTQMFlySTs8v1lnr1EZpsQBHATWrRBrNJG8CnCnGKJJbcrC6Vj7L9k3_Fy4WmT8/pub?gid=0&single=true&output=csv'
-    rd = pd.read_csv(raw_data_url, header=[0, 1], index_col=[0, 1, 2])
+    Load raw data from google sheet.
 
-    rd.sort_index(0, inplace=True)
-    rd.sort_index(1, inplace=True)
+    Parameters
+    ----------
+    use_cache : bool
+        If True, the downloaded sheet is stored in CACHE_DIR, and later
+        calls read the local copy.
+    refresh : bool
+        If True, download the sheet again and overwrite the cached copy.
+    max_age : float
+        Age of the cached copy, in days, after which the sheet is downloaded
+        again. If None, the cached copy never expires.
+
+    If the download fails (e.g. offline), an expired or refreshed cached
+    copy is returned instead, with a warning.
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    cache = os.path.join(CACHE_DIR, 'raw.pkl')
+    current = use_cache and not refresh and not _cache_expired(cache, max_age)
+    if current:
+        rd = _read_cache(cache)
+        if rd is not None:
+            return rd
+
+    try:
+        rd = pd.read_csv(RAW_DATA_URL, header=[0, 1], index_col=[0, 1, 2])
+    except OSError as e:
+        # fall back to the stale local copy, if it was not already tried
+        rd = _read_cache(cache) if use_cache and not current else None
+        if rd is None:
+            raise
+        warnings.warn('Could not download raw data ({}), using the cached copy from {}.'.format(
+            e, time.ctime(os.path.getmtime(cache))))
+        return rd
+    rd = sort_axes(rd)
+
+    if use_cache:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # write then rename, so an interrupted download never leaves a partial cache
+        tmp = cache + '.tmp'
+        rd.to_pickle(tmp)
+        os.replace(tmp, cache)
 
     return rd
 
+def _add_columns(rd, new):
+    """
+    Add new columns to rd in a single concat.
+
+    Parameters
+    ----------
+    rd : pandas.DataFrame
+    new : dict
+        Of {column tuple: values}. Existing columns with the same name are replaced.
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    if not new:
+        return rd
+    add = pd.DataFrame(dict(enumerate(new.values())), index=rd.index)
+    add.columns = pd.MultiIndex.from_tuples(new.keys())
+
+    rd = rd.drop(columns=[c for c in new if c in rd.columns])
+    return pd.concat([rd, add], axis=1)
+
 def package_errors(rd):
     """
-    Pack measurements with their associated uncertainties as uarrays.
+    Store the uncertainties of measurements in float '_eprop' columns.
+
+    Nominal values stay in the original measurement column, and the '_eprop'
+    column beside it holds the uncertainty. Uncertainties are propagated
+    analytically by the calc_* functions below.
+
+    Returns
+    -------
+    pandas.DataFrame
     """
+    new = {}
+
     # solid
     errcs = [c for c in rd.Solid.columns if 'std' in c]
 
     for ecol in errcs:
-        pcol = re.sub('_2?std', '', ecol)
         ncol = re.sub('_2?std', '_eprop', ecol)
 
-        rd.loc[:, ('Solid', ncol)] = un.uarray(rd.loc[:, ('Solid', pcol)],
-                                               rd.loc[:, ('Solid', ecol)])
+        new[('Solid', ncol)] = rd.loc[:, ('Solid', ecol)].astype(np.float64)
 
     # solution
     errcs = [c for c in rd.Solution.columns if 'std' in c]
 
     for ecol in errcs:
-        pcol = re.sub('_2?std', '', ecol)
         ncol = re.sub('_2?std', '_eprop', ecol)
 
-        rd.loc[:, ('Solution', ncol)] = un.uarray(rd.loc[:, ('Solution', pcol)],
-                                               rd.loc[:, ('Solution', ecol)])
-# Implement package_errors in all the above.
+        new[('Solution', ncol)] = rd.loc[:, ('Solution', ecol)].astype(np.float64)
+
+    return _add_columns(rd, new)
 
 def calc_phreeqc(rd, database='pitzer'):
     """
@@ -82,15 +174,19 @@ def calc_lambda(rd, numerator='B', denom='C', database='pitzer'):
 
     Returns
     -------
-        None
+    pandas.DataFrame
     """
-    rd.loc[:, ('Solid', 'LambdaB')] = ((1e-3 * rd.loc[:, ('Solid', 'B/Ca (umol/mol)')]) /
+    new = {}
+    new[('Solid', 'LambdaB')] = ((1e-3 * rd.loc[:, ('Solid', 'B/Ca (umol/mol)')]) /
                                        (rd.loc[:, (database, numerator)] /
                                         rd.loc[:, (database, denom)]))
     if 'B/Ca_eprop (umol/mol)' in rd.loc[:, 'Solid']:
-        rd.loc[:, ('Solid', 'LambdaB_eprop')] = ((1e-3 * rd.loc[:, ('Solid', 'B/Ca_eprop (umol/mol)')]) /
-                                                 (rd.loc[:, (database, numerator)] /
-                                                  rd.loc[:, (database, denom)]))
+        # the solution ratio is treated as exact, so the uncertainty scales linearly
+        new[('Solid', 'LambdaB_eprop')] = ((1e-3 * rd.loc[:, ('Solid', 'B/Ca_eprop (umol/mol)')]) /
+                                           (rd.loc[:, (database, numerator)] /
+                                            rd.loc[:, (database, denom)]))
+
+    return _add_columns(rd, new)
 
 def calc_sol_iso(rd, database='pitzer', borate_mode='total', alpha=1.026):
     """
@@ -110,26 +206,32 @@ def calc_sol_iso(rd, database='pitzer', borate_mode='total', alpha=1.026):
 
     Returns
     -------
+    pandas.DataFrame
     """
     if borate_mode == 'free':
         BO4_mode = 'BOH4_free'
     else:
         BO4_mode = 'BOH4'
 
-    d11BO4, d11BO3 = sol_B_iso_Rae2018(pH=rd.loc[:, (database, 'pH')],
-                                       BT=rd.loc[:, (database, 'B')],
-                                       BO4=rd.loc[:, (database, BO4_mode)],
-                                       d11BT=rd.loc[:, ('Solution', 'd11B (permil vs NIST951)')], alpha=alpha)
-    rd.loc[:, ('Solution', 'd11BO3 (permil vs NIST951)')] = d11BO3
-    rd.loc[:, ('Solution', 'd11BO4 (permil vs NIST951)')] = d11BO4
+    # [H+] and Kb are shared by the nominal and uncertainty calculations
+    Hval, Kbval = _precompute_HK(pH=rd.loc[:, (database, 'pH')],
+                                 BT=rd.loc[:, (database, 'B')],
+                                 BO4=rd.loc[:, (database, BO4_mode)])
+
+    d11BO4, d11BO3 = _solve_d11BO4(Hval, Kbval,
+                                   d11BT=rd.loc[:, ('Solution', 'd11B (permil vs NIST951)')], alpha=alpha)
+    new = {('Solution', 'd11BO3 (permil vs NIST951)'): d11BO3,
+           ('Solution', 'd11BO4 (permil vs NIST951)'): d11BO4}
 
     if 'd11B_eprop (permil vs NIST951)' in rd.loc[:, 'Solution']:
-        d11BO4, d11BO3 = sol_B_iso_Rae2018(pH=rd.loc[:, (database, 'pH')],
-                                           BT=rd.loc[:, (database, 'B')],
-                                           BO4=rd.loc[:, (database, BO4_mode)],
-                                           d11BT=rd.loc[:, ('Solution', 'd11B_eprop (permil vs NIST951)')], alpha=alpha)
-    rd.loc[:, ('Solution', 'd11BO3_eprop (permil vs NIST951)')] = d11BO3
-    rd.loc[:, ('Solution', 'd11BO4_eprop (permil vs NIST951)')] = d11BO4
+        d11BO4_err, d11BO3_err = _solve_d11BO4_err(Hval, Kbval,
+                                                   d11BT=rd.loc[:, ('Solution', 'd11B (permil vs NIST951)')],
+                                                   d11BT_err=rd.loc[:, ('Solution', 'd11B_eprop (permil vs NIST951)')],
+                                                   alpha=alpha)
+        new[('Solution', 'd11BO3_eprop (permil vs NIST951)')] = d11BO3_err
+        new[('Solution', 'd11BO4_eprop (permil vs NIST951)')] = d11BO4_err
+
+    return _add_columns(rd, new)
 
 def calc_epsilon(rd):
     """
@@ -143,14 +245,19 @@ def calc_epsilon(rd):
         created by raw_data()
     Returns
     -------
+    pandas.DataFrame
     """
-    rd.loc[:, ('Solid', 'EpsilonB')] = (rd.loc[:, ('Solid', 'd11B (permil vs NIST951)')] -
-                                        rd.loc[:, ('Solution', 'd11BO4 (permil vs NIST951)')])
+    new = {}
+    new[('Solid', 'EpsilonB')] = (rd.loc[:, ('Solid', 'd11B (permil vs NIST951)')] -
+                                  rd.loc[:, ('Solution', 'd11BO4 (permil vs NIST951)')])
     if 'd11B_eprop (permil vs NIST951)' in rd.loc[:, 'Solid'] and 'd11BO4_eprop (permil vs NIST951)' in rd.loc[:, 'Solution']:
-        rd.loc[:, ('Solid', 'EpsilonB_eprop')] = (rd.loc[:, ('Solid', 'd11B_eprop (permil vs NIST951)')] -
-                                                  rd.loc[:, ('Solution', 'd11BO4_eprop (permil vs NIST951)')])
+        # solid and solution d11B uncertainties are independent, so add in quadrature
+        new[('Solid', 'EpsilonB_eprop')] = np.sqrt(rd.loc[:, ('Solid', 'd11B_eprop (permil vs NIST951)')]**2 +
+                                                   rd.loc[:, ('Solution', 'd11BO4_eprop (permil vs NIST951)')]**2)
 
-def processed(database='pitzer', lambda_num='B', lambda_denom='C', borate_mode='total', alpha_sol=1.026):
+    return _add_columns(rd, new)
+
+def processed(database='pitzer', lambda_num='B', lambda_denom='C', borate_mode='total', alpha_sol=1.026, use_cache=True, refresh=False, max_age=7):
     """
     Load and process all data.
 
@@ -168,19 +275,23 @@ def processed(database='pitzer', lambda_num='B', lambda_denom='C', borate_mode='
     borate_mode : str
         Whether to use 'free' or 'total' borate when calculating B isotope fractionation.
         Should probably be 'total', but it can be interesting to see what 'free' does.
+    use_cache, refresh : bool
+        Passed to raw_data. If use_cache is True, read the raw data from the
+        local cache. If refresh is True, download it again first.
+    max_age : float
+        Passed to raw_data. Age of the cached raw data, in days, after which
+        it is downloaded again. If None, the cache never expires.
 
     Returns
     -------
     pandas.DataFrame
     """
-    rd = raw_data()
-    package_errors(rd)
+    rd = raw_data(use_cache=use_cache, refresh=refresh, max_age=max_age)
+    rd = package_errors(rd)
     rd = calc_phreeqc(rd, database)
-    calc_lambda(rd, database=database, numerator=lambda_num, denom=lambda_denom)
-    calc_sol_iso(rd, database, borate_mode=borate_mode, alpha=alpha_sol)
-    calc_epsilon(rd)
-
-    rd.sort_index(0, inplace=True)
-    rd.sort_index(1, inplace=True)
+    rd = calc_lambda(rd, database=database, numerator=lambda_num, denom=lambda_denom)
+    rd = calc_sol_iso(rd, database, borate_mode=borate_mode, alpha=alpha_sol)
+    rd = calc_epsilon(rd)
 
-    return rd
\ No newline at end of file
+    # copy consolidates the blocks added by each of the steps above
+    return sort_axes(rd).copy()
\ No newline at end of file
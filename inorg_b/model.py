@@ -1,44 +1,161 @@
+import math
 import numpy as np
-from .helpers import A11_2_d11, d11_2_A11, d11_2_R11, R11_2_d11
+from ._njit import HAS_NUMBA, njit
+from .helpers import LN10, _A11_2_d11, _d11_2_A11, _d11_2_R11, _R11_2_d11
 
+@njit(cache=True, fastmath=True, error_model="numpy")
 def rS_calc(Rb, Rp, Kf, rL, Kb):
     """
     Calculate rS from input parameters.
     """
     Rf = Rp + Rb
-    
+
     return (Kf * rL * Rf) / (Rb * Kb + Rp)
 
+@njit(cache=True, fastmath=True, error_model="numpy")
 def alpha_SKM(Rb, Rp, alpha_f, alpha_eq):
     return alpha_f / (1 + (Rb / (Rp + Rb)) * (alpha_f / alpha_eq - 1))
 
-def predfn(Kb3, Kf3, Kb4, Kf4, logRb, Rp, rL3, rL4, B_DIC, ABO3, ABO4, dBO4):
+def _prep(*arrays):
     """
-    Predict B partitioning and offset from d11B BOH4.
+    Broadcast inputs to flat float64 arrays for the compiled kernels.
 
     Returns
     -------
-    LambdaB, EpsilonB
+    shape, list of arrays
+    """
+    arrays = [np.asarray(a, dtype=np.float64) for a in arrays]
+    shape = max((a.shape for a in arrays), key=len)
+    # fast path for 1D arrays of equal length, optionally mixed with scalars.
+    # Scalars become zero-stride views, so no array is allocated for them.
+    if len(shape) == 1 and all((a.shape == shape and a.flags.c_contiguous) or a.ndim == 0 for a in arrays):
+        return shape, [a if a.ndim else np.broadcast_to(a, shape) for a in arrays]
+
+    arrays = np.broadcast_arrays(*arrays)
+    return arrays[0].shape, [np.ascontiguousarray(a).ravel() for a in arrays]
+
+def _use_kernel(*params):
+    """
+    True if the compiled kernels can be used: numba is installed, and no
+    model parameter is an array.
+    """
+    # getattr rather than np.ndim, which is slow enough to matter per fitfn call
+    return HAS_NUMBA and all(getattr(p, 'ndim', 0) == 0 for p in params)
+
+def _reshape(shape, *arrays):
+    """
+    Reshape the flat outputs of a kernel to shape, as floats if shape is ().
+    """
+    if not shape:
+        return tuple(a[0] for a in arrays)
+    return tuple(a.reshape(shape) for a in arrays)
+
+def _asarrays(*arrays):
+    """
+    Convert inputs to numpy arrays, for the uncompiled model functions.
+    """
+    return [np.asarray(a) for a in arrays]
+
+def _misfit(LambdaB_calc, EpsilonB_calc, LambdaB, LambdaB_w, EpsilonB, EpsilonB_w, LambdaB_bias):
+    """
+    Weighted misfit of model predictions, as accumulated by the compiled _fitfn* loops.
+    """
+    Lam_err = np.sum((LambdaB_calc - LambdaB)**2 * LambdaB_w)
+    Eps_err = np.sum((EpsilonB_calc - EpsilonB)**2 * EpsilonB_w)
+    return LambdaB_bias * Lam_err / 2 + Eps_err / 2
+
+def lambda_bias(LambdaB, EpsilonB):
+    """
+    Bias factor applied to LambdaB residuals, to account for the difference
+    in the variance of LambdaB and EpsilonB.
+
+    This only depends on the data, so calculate it once and pass it to the
+    fitfn* functions as LambdaB_bias when minimising.
     """
-    Rb = 10**logRb
-    
+    return np.ptp(EpsilonB) / np.ptp(LambdaB)
+
+def misfit_weights(LambdaB_err=1, EpsilonB_err=1):
+    """
+    Inverse variances (1 / err**2) of LambdaB and EpsilonB, used to weight the residuals.
+
+    These only depend on the data, so calculate them once and pass them to the
+    fitfn* functions as LambdaB_w and EpsilonB_w when minimising.
+
+    Returns
+    -------
+    LambdaB_w, EpsilonB_w
+    """
+    return 1 / np.square(LambdaB_err), 1 / np.square(EpsilonB_err)
+
+@njit(cache=True, fastmath=True, error_model="numpy")
+def _point(Kb3, Kf3, Kb4, Kf4, Rb, Rp, rL3, rL4, B_DIC, ABO3, ABO4, dBO4):
     # Partitioning Calculations
     rS4 = rS_calc(Rb, Rp, Kf4, rL4, Kb4)
     rS3 = rS_calc(Rb, Rp, Kf3, rL3, Kb3)
 
     rSB = rS3 + rS4  # total B/Ca of solid
-    
+
     KB = rSB / B_DIC  # calculate lambda partitioning
 
     # Isotope Calculations
     # Abundance of 11B in calcite via mixing calculation
     ABcal = (ABO3 * rS3 + ABO4 * rS4) / rSB
-    DdBcal = A11_2_d11(ABcal) - dBO4  # convert back to d11B
-    
+    DdBcal = _A11_2_d11(ABcal) - dBO4  # convert back to d11B
+
     return KB, DdBcal
 
+@njit(cache=True, fastmath=True, error_model="numpy")
+def _predfn(Kb3, Kf3, Kb4, Kf4, logRb, Rp, rL3, rL4, B_DIC, ABO3, ABO4, dBO4, KB, DdBcal):
+    Rb = math.exp(LN10 * logRb)
+
+    for i in range(Rp.size):
+        KB[i], DdBcal[i] = _point(Kb3, Kf3, Kb4, Kf4, Rb, Rp[i], rL3[i], rL4[i], B_DIC[i], ABO3[i], ABO4[i], dBO4[i])
+
+@njit(cache=True, fastmath=True, error_model="numpy")
+def _fitfn(Kb3, Kf3, Kb4, Kf4, logRb, Rp, rL3, rL4, B_DIC, ABO3, ABO4, dBO4,
+           LambdaB, LambdaB_w, EpsilonB, EpsilonB_w, LambdaB_bias):
+    """
+    Weighted misfit of the model, accumulated in the same loop as the predictions.
+
+    LambdaB_w and EpsilonB_w are the inverse variances (1 / err**2) of each point.
+    """
+    Rb = math.exp(LN10 * logRb)
+
+    Lam_err = 0.
+    Eps_err = 0.
+    for i in range(Rp.size):
+        KB, DdBcal = _point(Kb3, Kf3, Kb4, Kf4, Rb, Rp[i], rL3[i], rL4[i], B_DIC[i], ABO3[i], ABO4[i], dBO4[i])
+        Lam_err += (KB - LambdaB[i])**2 * LambdaB_w[i]
+        Eps_err += (DdBcal - EpsilonB[i])**2 * EpsilonB_w[i]
+    return LambdaB_bias * Lam_err / 2 + Eps_err / 2
+
+def predfn(Kb3, Kf3, Kb4, Kf4, logRb, Rp, rL3, rL4, B_DIC, ABO3, ABO4, dBO4):
+    """
+    Predict B partitioning and offset from d11B BOH4.
+
+    Model parameters may also be arrays that broadcast against the data, in
+    which case the model is evaluated with numpy instead of the compiled kernel.
+
+    Returns
+    -------
+    LambdaB, EpsilonB
+        Arrays with the broadcast shape of the inputs, or floats if all inputs are scalars.
+    """
+    if not _use_kernel(Kb3, Kf3, Kb4, Kf4, logRb):
+        # the _point functions are plain arithmetic, so work on whole arrays
+        return _point(Kb3, Kf3, Kb4, Kf4, 10**logRb, *_asarrays(Rp, rL3, rL4, B_DIC, ABO3, ABO4, dBO4))
+
+    shape, arrays = _prep(Rp, rL3, rL4, B_DIC, ABO3, ABO4, dBO4)
+    KB = np.empty(arrays[0].size)
+    DdBcal = np.empty(arrays[0].size)
+
+    _predfn(Kb3, Kf3, Kb4, Kf4, logRb, *arrays, KB, DdBcal)
+
+    return _reshape(shape, KB, DdBcal)
+
 def fitfn(p, Rp, rL3, rL4, B_DIC, ABO3, ABO4, dBO4, LambdaB, EpsilonB,
-          LambdaB_err=1, EpsilonB_err=1, LambdaB_bias=None):
+          LambdaB_err=1, EpsilonB_err=1, LambdaB_bias=None,
+          LambdaB_w=None, EpsilonB_w=None):
     """
     Function to minimise when fitting the model.
 
@@ -46,15 +163,26 @@ def fitfn(p, Rp, rL3, rL4, B_DIC, ABO3, ABO4, dBO4, LambdaB, EpsilonB,
     ----------
     p : tuple
         Parameters to fit, in the order (Kb3, Kf3, Kb4, Kf4, logRb).
+    LambdaB_bias : float
+        Weight of LambdaB residuals relative to EpsilonB residuals.
+        If None, it is calculated by lambda_bias on every call.
+    LambdaB_w, EpsilonB_w : float or array-like
+        Weights of the residuals, as returned by misfit_weights. If None, they
+        are calculated from LambdaB_err and EpsilonB_err on every call.
     """
     if LambdaB_bias is None:
-        LambdaB_bias = np.ptp(EpsilonB) / np.ptp(LambdaB)
+        LambdaB_bias = lambda_bias(LambdaB, EpsilonB)
+
+    if LambdaB_w is None or EpsilonB_w is None:
+        LambdaB_w, EpsilonB_w = misfit_weights(LambdaB_err, EpsilonB_err)
+    if not _use_kernel(*p):
+        LambdaB_calc, EpsilonB_calc = predfn(*p, Rp, rL3, rL4, B_DIC, ABO3, ABO4, dBO4)
+        return _misfit(LambdaB_calc, EpsilonB_calc, LambdaB, LambdaB_w, EpsilonB, EpsilonB_w, LambdaB_bias)
 
-    LambdaB_calc, EpsilonB_calc = predfn(*p, Rp, rL3, rL4, B_DIC, ABO3, ABO4, dBO4)
+    _, arrays = _prep(Rp, rL3, rL4, B_DIC, ABO3, ABO4, dBO4,
+                      LambdaB, LambdaB_w, EpsilonB, EpsilonB_w)
 
-    Lam_err = LambdaB_bias * np.sum((LambdaB_calc - LambdaB)**2 / (LambdaB_err**2))
-    Eps_err = np.sum((EpsilonB_calc - EpsilonB)**2 / (EpsilonB_err**2))
-    return Lam_err / 2 + Eps_err / 2
+    return _fitfn(*p, *arrays, LambdaB_bias)
 
     # Lam_err = -0.5 * np.sum((LambdaB_calc - LambdaB)**2 / (LambdaB_err**2) + np.log(2 * np.pi * LambdaB_err**2))
     # Eps_err = -0.5 * np.sum((EpsilonB_calc - EpsilonB)**2 / (EpsilonB_err**2) + np.log(2 * np.pi * LambdaB_err**2))
@@ -62,29 +190,66 @@ def fitfn(p, Rp, rL3, rL4, B_DIC, ABO3, ABO4, dBO4, LambdaB, EpsilonB,
     # return -(LambdaB_bias * Lam_err + Eps_err)
 
 # functions for fitting model with single species and fractionation
+@njit(cache=True, fastmath=True, error_model="numpy")
+def _point_single_species(Kb, Kf, Rb, epsilon, Rp, rL, B_DIC, dB, dBO4):
+    # Partitioning Calculations
+    rSB = rS_calc(Rb, Rp, Kf, rL, Kb)
+
+    KB = rSB / B_DIC  # calculate lambda partitioning
+
+    # Isotope Calculations
+    dBcal = dB + epsilon
+    DdBcal = dBcal - dBO4  # convert back to d11B
+
+    return KB, DdBcal
+
+@njit(cache=True, fastmath=True, error_model="numpy")
+def _predfn_single_species(Kb, Kf, logRb, epsilon, Rp, rL, B_DIC, dB, dBO4, KB, DdBcal):
+    Rb = math.exp(LN10 * logRb)
+
+    for i in range(Rp.size):
+        KB[i], DdBcal[i] = _point_single_species(Kb, Kf, Rb, epsilon, Rp[i], rL[i], B_DIC[i], dB[i], dBO4[i])
+
+@njit(cache=True, fastmath=True, error_model="numpy")
+def _fitfn_single_species(Kb, Kf, logRb, epsilon, Rp, rL, B_DIC, dB, dBO4,
+                          LambdaB, LambdaB_w, EpsilonB, EpsilonB_w, LambdaB_bias):
+    Rb = math.exp(LN10 * logRb)
+
+    Lam_err = 0.
+    Eps_err = 0.
+    for i in range(Rp.size):
+        KB, DdBcal = _point_single_species(Kb, Kf, Rb, epsilon, Rp[i], rL[i], B_DIC[i], dB[i], dBO4[i])
+        Lam_err += (KB - LambdaB[i])**2 * LambdaB_w[i]
+        Eps_err += (DdBcal - EpsilonB[i])**2 * EpsilonB_w[i]
+    return LambdaB_bias * Lam_err / 2 + Eps_err / 2
+
 def predfn_single_species(Kb, Kf, logRb, epsilon, Rp, rL, B_DIC, dB, dBO4):
     """
     Predict B partitioning and offset from d11B BOH4.
 
+    Model parameters may also be arrays that broadcast against the data, in
+    which case the model is evaluated with numpy instead of the compiled kernel.
+
     Returns
     -------
     LambdaB, EpsilonB
+        Arrays with the broadcast shape of the inputs, or floats if all inputs are scalars.
     """
-    Rb = 10**logRb
-    
-    # Partitioning Calculations
-    rSB = rS_calc(Rb, Rp, Kf, rL, Kb)
+    if not _use_kernel(Kb, Kf, logRb, epsilon):
+        # the _point functions are plain arithmetic, so work on whole arrays
+        return _point_single_species(Kb, Kf, 10**logRb, epsilon, *_asarrays(Rp, rL, B_DIC, dB, dBO4))
 
-    KB = rSB / B_DIC  # calculate lambda partitioning
+    shape, arrays = _prep(Rp, rL, B_DIC, dB, dBO4)
+    KB = np.empty(arrays[0].size)
+    DdBcal = np.empty(arrays[0].size)
 
-    # Isotope Calculations
-    dBcal = dB + epsilon
-    DdBcal = dBcal - dBO4  # convert back to d11B
-    
-    return KB, DdBcal
+    _predfn_single_species(Kb, Kf, logRb, epsilon, *arrays, KB, DdBcal)
+
+    return _reshape(shape, KB, DdBcal)
 
 def fitfn_single_species(p, Rp, rL, B_DIC, dB, dBO4, LambdaB, EpsilonB,
-          LambdaB_err=1, EpsilonB_err=1, LambdaB_bias=None):
+          LambdaB_err=1, EpsilonB_err=1, LambdaB_bias=None,
+          LambdaB_w=None, EpsilonB_w=None):
     """
     Function to minimise when fitting the model.
 
@@ -92,48 +257,96 @@ def fitfn_single_species(p, Rp, rL, B_DIC, dB, dBO4, LambdaB, EpsilonB,
     ----------
     p : tuple
         Parameters to fit, in the order (Kb, Kf, logRb, epsilon).
+    LambdaB_bias : float
+        Weight of LambdaB residuals relative to EpsilonB residuals.
+        If None, it is calculated by lambda_bias on every call.
+    LambdaB_w, EpsilonB_w : float or array-like
+        Weights of the residuals, as returned by misfit_weights. If None, they
+        are calculated from LambdaB_err and EpsilonB_err on every call.
     """
     if LambdaB_bias is None:
-        LambdaB_bias = np.ptp(EpsilonB) / np.ptp(LambdaB)
+        LambdaB_bias = lambda_bias(LambdaB, EpsilonB)
 
-    LambdaB_calc, EpsilonB_calc = predfn_single_species(*p, Rp, rL, B_DIC, dB, dBO4)
+    if LambdaB_w is None or EpsilonB_w is None:
+        LambdaB_w, EpsilonB_w = misfit_weights(LambdaB_err, EpsilonB_err)
+    if not _use_kernel(*p):
+        LambdaB_calc, EpsilonB_calc = predfn_single_species(*p, Rp, rL, B_DIC, dB, dBO4)
+        return _misfit(LambdaB_calc, EpsilonB_calc, LambdaB, LambdaB_w, EpsilonB, EpsilonB_w, LambdaB_bias)
 
-    Lam_err = LambdaB_bias * np.sum((LambdaB_calc - LambdaB)**2 / (LambdaB_err**2))
-    Eps_err = np.sum((EpsilonB_calc - EpsilonB)**2 / (EpsilonB_err**2))
-    return Lam_err / 2 + Eps_err / 2
+    _, arrays = _prep(Rp, rL, B_DIC, dB, dBO4,
+                      LambdaB, LambdaB_w, EpsilonB, EpsilonB_w)
 
-# functions for rate-dependent fractionation of single species
-def predfn_single_species_R(Kb, Kf, alpha_eq, alpha_f, logRb, Rp, rL, B_DIC, dBO4):
-    """
-    Predict B partitioning and R-dependent offset from d11B BOH4.
+    return _fitfn_single_species(*p, *arrays, LambdaB_bias)
 
-    Returns
-    -------
-    LambdaB, EpsilonB
-    """
-    Rb = 10**logRb
-    
+# functions for rate-dependent fractionation of single species
+@njit(cache=True, fastmath=True, error_model="numpy")
+def _point_single_species_R(Kb, Kf, alpha_eq, alpha_f, Rb, Rp, rL, B_DIC, dBO4):
     # Partitioning Calculations
     rSB = rS_calc(Rb, Rp, Kf, rL, Kb)
 
     KB = rSB / B_DIC  # calculate lambda partitioning
-    
+
     # Isotope Calculations
-    
+
     # calculate fractionation from borate to solid
     alpha_solid = alpha_SKM(Rb, Rp, alpha_f, alpha_eq)
-    
+
     # calculcate fluid borate ratio
-    rBO4 = d11_2_R11(dBO4)
+    rBO4 = _d11_2_R11(dBO4)
     rsolid = rBO4 * alpha_solid
-    dBsolid = R11_2_d11(rsolid)
-    
+    dBsolid = _R11_2_d11(rsolid)
+
     DdBcal = dBsolid - dBO4
-    
+
     return KB, DdBcal
 
+@njit(cache=True, fastmath=True, error_model="numpy")
+def _predfn_single_species_R(Kb, Kf, alpha_eq, alpha_f, logRb, Rp, rL, B_DIC, dBO4, KB, DdBcal):
+    Rb = math.exp(LN10 * logRb)
+
+    for i in range(Rp.size):
+        KB[i], DdBcal[i] = _point_single_species_R(Kb, Kf, alpha_eq, alpha_f, Rb, Rp[i], rL[i], B_DIC[i], dBO4[i])
+
+@njit(cache=True, fastmath=True, error_model="numpy")
+def _fitfn_single_species_R(Kb, Kf, alpha_eq, alpha_f, logRb, Rp, rL, B_DIC, dBO4,
+                            LambdaB, LambdaB_w, EpsilonB, EpsilonB_w, LambdaB_bias):
+    Rb = math.exp(LN10 * logRb)
+
+    Lam_err = 0.
+    Eps_err = 0.
+    for i in range(Rp.size):
+        KB, DdBcal = _point_single_species_R(Kb, Kf, alpha_eq, alpha_f, Rb, Rp[i], rL[i], B_DIC[i], dBO4[i])
+        Lam_err += (KB - LambdaB[i])**2 * LambdaB_w[i]
+        Eps_err += (DdBcal - EpsilonB[i])**2 * EpsilonB_w[i]
+    return LambdaB_bias * Lam_err / 2 + Eps_err / 2
+
+def predfn_single_species_R(Kb, Kf, alpha_eq, alpha_f, logRb, Rp, rL, B_DIC, dBO4):
+    """
+    Predict B partitioning and R-dependent offset from d11B BOH4.
+
+    Model parameters may also be arrays that broadcast against the data, in
+    which case the model is evaluated with numpy instead of the compiled kernel.
+
+    Returns
+    -------
+    LambdaB, EpsilonB
+        Arrays with the broadcast shape of the inputs, or floats if all inputs are scalars.
+    """
+    if not _use_kernel(Kb, Kf, alpha_eq, alpha_f, logRb):
+        # the _point functions are plain arithmetic, so work on whole arrays
+        return _point_single_species_R(Kb, Kf, alpha_eq, alpha_f, 10**logRb, *_asarrays(Rp, rL, B_DIC, dBO4))
+
+    shape, arrays = _prep(Rp, rL, B_DIC, dBO4)
+    KB = np.empty(arrays[0].size)
+    DdBcal = np.empty(arrays[0].size)
+
+    _predfn_single_species_R(Kb, Kf, alpha_eq, alpha_f, logRb, *arrays, KB, DdBcal)
+
+    return _reshape(shape, KB, DdBcal)
+
 def fitfn_single_species_R(p, Rp, rL, B_DIC, dBO4, LambdaB, EpsilonB,
-                         LambdaB_err=1, EpsilonB_err=1, LambdaB_bias=None):
+                         LambdaB_err=1, EpsilonB_err=1, LambdaB_bias=None,
+                         LambdaB_w=None, EpsilonB_w=None):
     """
     Function to minimise when fitting the model.
 
@@ -141,44 +354,92 @@ def fitfn_single_species_R(p, Rp, rL, B_DIC, dBO4, LambdaB, EpsilonB,
     ----------
     p : tuple
         Parameters to fit, in the order (Kb, Kf, logRb, epsilon).
+    LambdaB_bias : float
+        Weight of LambdaB residuals relative to EpsilonB residuals.
+        If None, it is calculated by lambda_bias on every call.
+    LambdaB_w, EpsilonB_w : float or array-like
+        Weights of the residuals, as returned by misfit_weights. If None, they
+        are calculated from LambdaB_err and EpsilonB_err on every call.
     """
     if LambdaB_bias is None:
-        LambdaB_bias = np.ptp(EpsilonB) / np.ptp(LambdaB)
+        LambdaB_bias = lambda_bias(LambdaB, EpsilonB)
 
-    LambdaB_calc, EpsilonB_calc = predfn_single_species_R(*p, Rp, rL, B_DIC, dBO4)
+    if LambdaB_w is None or EpsilonB_w is None:
+        LambdaB_w, EpsilonB_w = misfit_weights(LambdaB_err, EpsilonB_err)
+    if not _use_kernel(*p):
+        LambdaB_calc, EpsilonB_calc = predfn_single_species_R(*p, Rp, rL, B_DIC, dBO4)
+        return _misfit(LambdaB_calc, EpsilonB_calc, LambdaB, LambdaB_w, EpsilonB, EpsilonB_w, LambdaB_bias)
 
-    Lam_err = LambdaB_bias * np.sum((LambdaB_calc - LambdaB)**2 / (LambdaB_err**2))
-    Eps_err = np.sum((EpsilonB_calc - EpsilonB)**2 / (EpsilonB_err**2))
-    return Lam_err / 2 + Eps_err / 2
+    _, arrays = _prep(Rp, rL, B_DIC, dBO4,
+                      LambdaB, LambdaB_w, EpsilonB, EpsilonB_w)
 
-# functions for exploring fractionation in BO4 only species
-def predfn_BO4fractionated(Kb3, Kf3, Kb4, Kf4, logRb, eps4, Rp, rL3, rL4, B_DIC, dBO3, dBO4):
-    """
-    Predict B partitioning and offset from d11B BOH4.
+    return _fitfn_single_species_R(*p, *arrays, LambdaB_bias)
 
-    Returns
-    -------
-    LambdaB, EpsilonB
-    """
-    Rb = 10**logRb
-    
+# functions for exploring fractionation in BO4 only species
+@njit(cache=True, fastmath=True, error_model="numpy")
+def _point_BO4fractionated(Kb3, Kf3, Kb4, Kf4, Rb, eps4, Rp, rL3, rL4, B_DIC, dBO3, dBO4):
     # Partitioning Calculations
     rS4 = rS_calc(Rb, Rp, Kf4, rL4, Kb4)
     rS3 = rS_calc(Rb, Rp, Kf3, rL3, Kb3)
 
     rSB = rS3 + rS4  # total B/Ca of solid
-    
+
     KB = rSB / B_DIC  # calculate lambda partitioning
 
     # Isotope Calculations
     # Abundance of 11B in calcite via mixing calculation
-    ABcal = (d11_2_A11(dBO3) * rS3 + d11_2_A11(dBO4 + eps4) * rS4) / rSB
-    DdBcal = A11_2_d11(ABcal) - dBO4  # convert back to d11B
-    
+    ABcal = (_d11_2_A11(dBO3) * rS3 + _d11_2_A11(dBO4 + eps4) * rS4) / rSB
+    DdBcal = _A11_2_d11(ABcal) - dBO4  # convert back to d11B
+
     return KB, DdBcal
 
+@njit(cache=True, fastmath=True, error_model="numpy")
+def _predfn_BO4fractionated(Kb3, Kf3, Kb4, Kf4, logRb, eps4, Rp, rL3, rL4, B_DIC, dBO3, dBO4, KB, DdBcal):
+    Rb = math.exp(LN10 * logRb)
+
+    for i in range(Rp.size):
+        KB[i], DdBcal[i] = _point_BO4fractionated(Kb3, Kf3, Kb4, Kf4, Rb, eps4, Rp[i], rL3[i], rL4[i], B_DIC[i], dBO3[i], dBO4[i])
+
+@njit(cache=True, fastmath=True, error_model="numpy")
+def _fitfn_BO4fractionated(Kb3, Kf3, Kb4, Kf4, logRb, eps4, Rp, rL3, rL4, B_DIC, dBO3, dBO4,
+                           LambdaB, LambdaB_w, EpsilonB, EpsilonB_w, LambdaB_bias):
+    Rb = math.exp(LN10 * logRb)
+
+    Lam_err = 0.
+    Eps_err = 0.
+    for i in range(Rp.size):
+        KB, DdBcal = _point_BO4fractionated(Kb3, Kf3, Kb4, Kf4, Rb, eps4, Rp[i], rL3[i], rL4[i], B_DIC[i], dBO3[i], dBO4[i])
+        Lam_err += (KB - LambdaB[i])**2 * LambdaB_w[i]
+        Eps_err += (DdBcal - EpsilonB[i])**2 * EpsilonB_w[i]
+    return LambdaB_bias * Lam_err / 2 + Eps_err / 2
+
+def predfn_BO4fractionated(Kb3, Kf3, Kb4, Kf4, logRb, eps4, Rp, rL3, rL4, B_DIC, dBO3, dBO4):
+    """
+    Predict B partitioning and offset from d11B BOH4.
+
+    Model parameters may also be arrays that broadcast against the data, in
+    which case the model is evaluated with numpy instead of the compiled kernel.
+
+    Returns
+    -------
+    LambdaB, EpsilonB
+        Arrays with the broadcast shape of the inputs, or floats if all inputs are scalars.
+    """
+    if not _use_kernel(Kb3, Kf3, Kb4, Kf4, logRb, eps4):
+        # the _point functions are plain arithmetic, so work on whole arrays
+        return _point_BO4fractionated(Kb3, Kf3, Kb4, Kf4, 10**logRb, eps4, *_asarrays(Rp, rL3, rL4, B_DIC, dBO3, dBO4))
+
+    shape, arrays = _prep(Rp, rL3, rL4, B_DIC, dBO3, dBO4)
+    KB = np.empty(arrays[0].size)
+    DdBcal = np.empty(arrays[0].size)
+
+    _predfn_BO4fractionated(Kb3, Kf3, Kb4, Kf4, logRb, eps4, *arrays, KB, DdBcal)
+
+    return _reshape(shape, KB, DdBcal)
+
 def fitfn_BO4fractionated(p, Rp, rL3, rL4, B_DIC, dBO3, dBO4, LambdaB, EpsilonB,
-          LambdaB_err=1, EpsilonB_err=1, LambdaB_bias=None):
+          LambdaB_err=1, EpsilonB_err=1, LambdaB_bias=None,
+          LambdaB_w=None, EpsilonB_w=None):
     """
     Function to minimise when fitting the model.
 
@@ -186,44 +447,92 @@ def fitfn_BO4fractionated(p, Rp, rL3, rL4, B_DIC, dBO3, dBO4, LambdaB, EpsilonB,
     ----------
     p : tuple
         Parameters to fit, in the order (Kb3, Kf3, Kb4, Kf4, logRb, eps4).
+    LambdaB_bias : float
+        Weight of LambdaB residuals relative to EpsilonB residuals.
+        If None, it is calculated by lambda_bias on every call.
+    LambdaB_w, EpsilonB_w : float or array-like
+        Weights of the residuals, as returned by misfit_weights. If None, they
+        are calculated from LambdaB_err and EpsilonB_err on every call.
     """
     if LambdaB_bias is None:
-        LambdaB_bias = np.ptp(EpsilonB) / np.ptp(LambdaB)
+        LambdaB_bias = lambda_bias(LambdaB, EpsilonB)
 
-    LambdaB_calc, EpsilonB_calc = predfn_BO4fractionated(*p, Rp, rL3, rL4, B_DIC, dBO3, dBO4)
+    if LambdaB_w is None or EpsilonB_w is None:
+        LambdaB_w, EpsilonB_w = misfit_weights(LambdaB_err, EpsilonB_err)
+    if not _use_kernel(*p):
+        LambdaB_calc, EpsilonB_calc = predfn_BO4fractionated(*p, Rp, rL3, rL4, B_DIC, dBO3, dBO4)
+        return _misfit(LambdaB_calc, EpsilonB_calc, LambdaB, LambdaB_w, EpsilonB, EpsilonB_w, LambdaB_bias)
 
-    Lam_err = LambdaB_bias * np.sum((LambdaB_calc - LambdaB)**2 / (LambdaB_err**2))
-    Eps_err = np.sum((EpsilonB_calc - EpsilonB)**2 / (EpsilonB_err**2))
-    return Lam_err / 2 + Eps_err / 2
+    _, arrays = _prep(Rp, rL3, rL4, B_DIC, dBO3, dBO4,
+                      LambdaB, LambdaB_w, EpsilonB, EpsilonB_w)
 
-# functions for exploring fractionation in both species
-def predfn_fractionated(Kb3, Kf3, Kb4, Kf4, logRb, eps3, eps4, Rp, rL3, rL4, B_DIC, dBO3, dBO4):
-    """
-    Predict B partitioning and offset from d11B BOH4.
+    return _fitfn_BO4fractionated(*p, *arrays, LambdaB_bias)
 
-    Returns
-    -------
-    LambdaB, EpsilonB
-    """
-    Rb = 10**logRb
-    
+# functions for exploring fractionation in both species
+@njit(cache=True, fastmath=True, error_model="numpy")
+def _point_fractionated(Kb3, Kf3, Kb4, Kf4, Rb, eps3, eps4, Rp, rL3, rL4, B_DIC, dBO3, dBO4):
     # Partitioning Calculations
     rS4 = rS_calc(Rb, Rp, Kf4, rL4, Kb4)
     rS3 = rS_calc(Rb, Rp, Kf3, rL3, Kb3)
 
     rSB = rS3 + rS4  # total B/Ca of solid
-    
+
     KB = rSB / B_DIC  # calculate lambda partitioning
 
     # Isotope Calculations
     # Abundance of 11B in calcite via mixing calculation
-    ABcal = (d11_2_A11(dBO3 + eps3) * rS3 + d11_2_A11(dBO4 + eps4) * rS4) / rSB
-    DdBcal = A11_2_d11(ABcal) - dBO4  # convert back to d11B
-    
+    ABcal = (_d11_2_A11(dBO3 + eps3) * rS3 + _d11_2_A11(dBO4 + eps4) * rS4) / rSB
+    DdBcal = _A11_2_d11(ABcal) - dBO4  # convert back to d11B
+
     return KB, DdBcal
 
+@njit(cache=True, fastmath=True, error_model="numpy")
+def _predfn_fractionated(Kb3, Kf3, Kb4, Kf4, logRb, eps3, eps4, Rp, rL3, rL4, B_DIC, dBO3, dBO4, KB, DdBcal):
+    Rb = math.exp(LN10 * logRb)
+
+    for i in range(Rp.size):
+        KB[i], DdBcal[i] = _point_fractionated(Kb3, Kf3, Kb4, Kf4, Rb, eps3, eps4, Rp[i], rL3[i], rL4[i], B_DIC[i], dBO3[i], dBO4[i])
+
+@njit(cache=True, fastmath=True, error_model="numpy")
+def _fitfn_fractionated(Kb3, Kf3, Kb4, Kf4, logRb, eps3, eps4, Rp, rL3, rL4, B_DIC, dBO3, dBO4,
+                        LambdaB, LambdaB_w, EpsilonB, EpsilonB_w, LambdaB_bias):
+    Rb = math.exp(LN10 * logRb)
+
+    Lam_err = 0.
+    Eps_err = 0.
+    for i in range(Rp.size):
+        KB, DdBcal = _point_fractionated(Kb3, Kf3, Kb4, Kf4, Rb, eps3, eps4, Rp[i], rL3[i], rL4[i], B_DIC[i], dBO3[i], dBO4[i])
+        Lam_err += (KB - LambdaB[i])**2 * LambdaB_w[i]
+        Eps_err += (DdBcal - EpsilonB[i])**2 * EpsilonB_w[i]
+    return LambdaB_bias * Lam_err / 2 + Eps_err / 2
+
+def predfn_fractionated(Kb3, Kf3, Kb4, Kf4, logRb, eps3, eps4, Rp, rL3, rL4, B_DIC, dBO3, dBO4):
+    """
+    Predict B partitioning and offset from d11B BOH4.
+
+    Model parameters may also be arrays that broadcast against the data, in
+    which case the model is evaluated with numpy instead of the compiled kernel.
+
+    Returns
+    -------
+    LambdaB, EpsilonB
+        Arrays with the broadcast shape of the inputs, or floats if all inputs are scalars.
+    """
+    if not _use_kernel(Kb3, Kf3, Kb4, Kf4, logRb, eps3, eps4):
+        # the _point functions are plain arithmetic, so work on whole arrays
+        return _point_fractionated(Kb3, Kf3, Kb4, Kf4, 10**logRb, eps3, eps4, *_asarrays(Rp, rL3, rL4, B_DIC, dBO3, dBO4))
+
+    shape, arrays = _prep(Rp, rL3, rL4, B_DIC, dBO3, dBO4)
+    KB = np.empty(arrays[0].size)
+    DdBcal = np.empty(arrays[0].size)
+
+    _predfn_fractionated(Kb3, Kf3, Kb4, Kf4, logRb, eps3, eps4, *arrays, KB, DdBcal)
+
+    return _reshape(shape, KB, DdBcal)
+
 def fitfn_fractionated(p, Rp, rL3, rL4, B_DIC, dBO3, dBO4, LambdaB, EpsilonB,
-          LambdaB_err=1, EpsilonB_err=1, LambdaB_bias=None):
+          LambdaB_err=1, EpsilonB_err=1, LambdaB_bias=None,
+          LambdaB_w=None, EpsilonB_w=None):
     """
     Function to minimise when fitting the model.
 
@@ -231,12 +540,23 @@ def fitfn_fractionated(p, Rp, rL3, rL4, B_DIC, dBO3, dBO4, LambdaB, EpsilonB,
     ----------
     p : tuple
         Parameters to fit, in the order (Kb3, Kf3, Kb4, Kf4, logRb, eps3, eps4).
+    LambdaB_bias : float
+        Weight of LambdaB residuals relative to EpsilonB residuals.
+        If None, it is calculated by lambda_bias on every call.
+    LambdaB_w, EpsilonB_w : float or array-like
+        Weights of the residuals, as returned by misfit_weights. If None, they
+        are calculated from LambdaB_err and EpsilonB_err on every call.
     """
     if LambdaB_bias is None:
-        LambdaB_bias = np.ptp(EpsilonB) / np.ptp(LambdaB)
+        LambdaB_bias = lambda_bias(LambdaB, EpsilonB)
+
+    if LambdaB_w is None or EpsilonB_w is None:
+        LambdaB_w, EpsilonB_w = misfit_weights(LambdaB_err, EpsilonB_err)
+    if not _use_kernel(*p):
+        LambdaB_calc, EpsilonB_calc = predfn_fractionated(*p, Rp, rL3, rL4, B_DIC, dBO3, dBO4)
+        return _misfit(LambdaB_calc, EpsilonB_calc, LambdaB, LambdaB_w, EpsilonB, EpsilonB_w, LambdaB_bias)
 
-    LambdaB_calc, EpsilonB_calc = predfn_fractionated(*p, Rp, rL3, rL4, B_DIC, dBO3, dBO4)
+    _, arrays = _prep(Rp, rL3, rL4, B_DIC, dBO3, dBO4,
+                      LambdaB, LambdaB_w, EpsilonB, EpsilonB_w)
 
-    Lam_err = LambdaB_bias * np.sum((LambdaB_calc - LambdaB)**2 / (LambdaB_err**2))
-    Eps_err = np.sum((EpsilonB_calc - EpsilonB)**2 / (EpsilonB_err**2))
-    return Lam_err / 2 + Eps_err / 2
\ No newline at end of file
+    return _fitfn_fractionated(*p, *arrays, LambdaB_bias)
@@ -3,31 +3,27 @@ Functions for calculating the speciation of C and B in precipitation solutions.
 """
 
 import os
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from .helpers import sort_axes
 import phreeqpy.iphreeqc.phreeqc_dll as phreeqc_mod
 
 
-def input_str(temp=25, pH=8.1, Na=0, Cl=0, K=0, B=0, Ca=0, DIC=0, Mg=0, SO4=0, units='mol/L'):
-    """
-    Generate phreeqc input string for calculating C and B chemistry of solution.
-    """
-    template = """SOLUTION 1
+# input string templates, assembled once at import
+_SOLUTION_TEMPLATE = """SOLUTION {n:d}
         temp      {temp:.3f}
         pH        {pH:.3f}
         pe        4
         redox     pe
         units     {units:s}
         density   1
-        Cl        {Cl:.6f}
-        Na        {Na:.6f}
-        Mg        {Mg:.6f}
-        B         {B:.6f}
-        Ca        {Ca:.6f}
-        C         {DIC:.6f}
-        K         {K:.6f}
-        S(6)      {SO4:.6f}
+{solutes:s}
         -water    1 # kg
+"""
 
+_SELECTED_OUTPUT = """
     SELECTED_OUTPUT
         -pH
         -temperature
@@ -45,17 +41,80 @@ def input_str(temp=25, pH=8.1, Na=0, Cl=0, K=0, B=0, Ca=0, DIC=0, Mg=0, SO4=0, u
     END
     """
 
-    return template.format(temp=temp,
-                           pH=pH,
-                           Na=Na,
-                           Cl=Cl,
-                           B=B,
-                           Ca=Ca,
-                           DIC=DIC,
-                           Mg=Mg,
-                           SO4=SO4,
-                           units=units,
-                           K=K)
+def input_str(temp=25, pH=8.1, Na=0, Cl=0, K=0, B=0, Ca=0, DIC=0, Mg=0, SO4=0, units='mol/L',
+              n=1, selected_output=True):
+    """
+    Generate phreeqc input string for calculating C and B chemistry of solution.
+
+    Solutes with zero concentration are left out of the SOLUTION block.
+
+    Parameters
+    ----------
+    n : int
+        The SOLUTION number.
+    selected_output : bool
+        If True, include the SELECTED_OUTPUT definition. Otherwise
+        the SOLUTION block is simply ended, relying on a SELECTED_OUTPUT
+        defined earlier in the same input.
+    """
+    solutes = (('Cl', Cl), ('Na', Na), ('Mg', Mg), ('B', B), ('Ca', Ca),
+               ('C', DIC), ('K', K), ('S(6)', SO4))
+    solutes = '\n'.join(f'        {name:10s}{val:.6f}' for name, val in solutes if val != 0)
+
+    solution = _SOLUTION_TEMPLATE.format(n=n, temp=temp, pH=pH, units=units, solutes=solutes)
+    if selected_output:
+        return solution + _SELECTED_OUTPUT
+    return solution + 'END\n'
+
+# IPhreeqc instances, keyed by (phreeq_path, dbase_path), so that the shared
+# library and database are only loaded once per session.
+_phreeqc_instances = {}
+
+def get_phreeqc(dbase_path, phreeq_path='/usr/local/lib/libiphreeqc.so'):
+    """
+    Return an IPhreeqc instance with the specified database loaded.
+
+    Instances are cached, so repeated calls with the same paths
+    re-use the same instance.
+
+    Parameters
+    ----------
+    dbase_path : str
+        Path to valid phreeqc database (e.g. minteq.v4.dat)
+    phreeq_path : str
+        Path to iphreeqc shared library.
+
+    Returns
+    -------
+    phreeqpy.iphreeqc.phreeqc_dll.IPhreeqc
+    """
+    key = (phreeq_path, dbase_path)
+    if key not in _phreeqc_instances:
+        phreeqc = phreeqc_mod.IPhreeqc(phreeq_path)
+        phreeqc.load_database(dbase_path)
+        _phreeqc_instances[key] = phreeqc
+    return _phreeqc_instances[key]
+
+def run_string(input_string, dbase_path, phreeq_path='/usr/local/lib/libiphreeqc.so'):
+    """
+    Run input string in phreeqc with specified database.
+
+    Parameters
+    ----------
+    input_string : str
+        Valid phreeqc input string with SELECTED_OUTPUT.
+    dbase_path : str
+        Path to valid phreeqc database (e.g. minteq.v4.dat)
+    phreeq_path : str
+        Path to iphreeqc shared library.
+
+    Returns
+    -------
+    list of SELECTED_OUTPUT rows, where the first row contains the column names.
+    """
+    phreeqc = get_phreeqc(dbase_path, phreeq_path)
+    phreeqc.run_string(input_string)
+    return phreeqc.get_selected_output_array()
 
 def run_phreeqc(input_string, dbase_path, phreeq_path='/usr/local/lib/libiphreeqc.so'):
     """
@@ -74,12 +133,18 @@ def run_phreeqc(input_string, dbase_path, phreeq_path='/usr/local/lib/libiphreeq
     -------
     pandas.Series of calculated species
     """
-    phreeqc = phreeqc_mod.IPhreeqc(phreeq_path)
-    phreeqc.load_database(dbase_path)
-    phreeqc.run_string(input_string)
-    out = phreeqc.get_selected_output_array()
+    out = run_string(input_string, dbase_path, phreeq_path)
     return pd.Series(out[1], out[0])
 
+def dbase_file(dbase='pitzer', database_path=None):
+    """
+    Return the path to the named phreeqc database file.
+    """
+    # path to phreeqc database files
+    if database_path is None:
+        database_path = "/home/oscar/phreeqc/iphreeqc-3.3.9-11951/database/"
+    return os.path.join(database_path, dbase + '.dat')
+
 # function to calculate solution C and B speciation
 def calc_cb(temp=25, pH=8.1, Na=0, Cl=0, K=0, B=0, Ca=0, DIC=0, Mg=0, SO4=0, dbase='pitzer', database_path=None, summ=True, phreeq_path='/usr/local/lib/libiphreeqc.so'):  
     """
@@ -99,60 +164,93 @@ def calc_cb(temp=25, pH=8.1, Na=0, Cl=0, K=0, B=0, Ca=0, DIC=0, Mg=0, SO4=0, dba
     -------
     pandas.Series of results.
     """
-    # path to phreeqc database files
-    if database_path is None:
-        database_path = "/home/oscar/phreeqc/iphreeqc-3.3.9-11951/database/"
     # create input string
     inp = input_str(temp, pH, Na, Cl, K, B, Ca, DIC, Mg, SO4)
     # run phreeqc
-    dat = run_phreeqc(inp, os.path.join(database_path, dbase + '.dat'), phreeq_path=phreeq_path)
+    dat = run_phreeqc(inp, dbase_file(dbase, database_path), phreeq_path=phreeq_path)
 
     if summ:
-        # return C and B chemistry (simple ions only)
-        out = pd.Series(index=['C', 'CO2', 'HCO3', 'CO3', 'B', 'BOH3', 'BOH4'])
-        # carbon species
-        out['C'] = dat['C(mol/kgw)']
-        if dat['m_CO2(mol/kgw)'] != 0:
-            out['CO2'] = dat['m_CO2(mol/kgw)']
-        else:
-            out['CO2'] = dat['m_H2CO3(mol/kgw)']
-
-        out['HCO3'] = dat['m_HCO3-(mol/kgw)']
-        out['CO3'] = dat['m_CO3-2(mol/kgw)']
-        # boron species
-        out['B'] = dat['B(mol/kgw)']
-        if dat['m_B(OH)3(mol/kgw)'] != 0:
-            out['BOH3'] = dat['m_B(OH)3(mol/kgw)']
-        else:
-            out['BOH3'] = dat['m_H3BO3(mol/kgw)']
-        if dat['m_B(OH)4-(mol/kgw)'] != 0:
-            out['BOH4'] = dat['m_B(OH)4-(mol/kgw)'] + dat['m_CaB(OH)4+(mol/kgw)']
-            out['BOH4_free'] = dat['m_B(OH)4-(mol/kgw)']
-        else:
-            out['BOH4'] = dat['m_H2BO3-(mol/kgw)'] + dat['m_NaH2BO3(mol/kgw)']  + dat['m_CaH2BO3+(mol/kgw)']
-            out['BOH4_free'] = dat['m_H2BO3-(mol/kgw)']
-
-        # auxillary data
-        out['pH'] = dat['pH']
-        out['temp'] = dat['temp(C)']
-        out['alk'] = dat['Alk(eq/kgw)']
-        out['SIc'] = dat['si_Calcite']
-        out['SIa'] = dat['si_Aragonite']
-        out['ion_str'] = dat['mu']
-
-        out['Ca'] = dat['Ca(mol/kgw)']
-        out['Na'] = dat['Na(mol/kgw)']
-        out['Cl'] = dat['Cl(mol/kgw)']
-        out['Mg'] = dat['Mg(mol/kgw)']
-        out['K'] = dat['K(mol/kgw)']
-        out['SO4'] = dat['S(6)(mol/kgw)']
-
-        return out
+        return summarise(dat.to_frame().T).iloc[0].rename(None)
     else:
         return dat
 
+def summarise(dat):
+    """
+    Summarise C and B chemistry (simple ions only) from phreeqc output.
+
+    Column names are tweaked to accommodate different B species returned
+    by pitzer / minteq.v4 databases.
+
+    Parameters
+    ----------
+    dat : pandas.DataFrame
+        SELECTED_OUTPUT of calc_cb, with one row per solution.
+
+    Returns
+    -------
+    pandas.DataFrame with the same index as dat.
+    """
+    out = pd.DataFrame(index=dat.index)
+    # carbon species
+    out['C'] = dat['C(mol/kgw)']
+    out['CO2'] = np.where(dat['m_CO2(mol/kgw)'] != 0,
+                          dat['m_CO2(mol/kgw)'], dat['m_H2CO3(mol/kgw)'])
+
+    out['HCO3'] = dat['m_HCO3-(mol/kgw)']
+    out['CO3'] = dat['m_CO3-2(mol/kgw)']
+    # boron species
+    out['B'] = dat['B(mol/kgw)']
+    out['BOH3'] = np.where(dat['m_B(OH)3(mol/kgw)'] != 0,
+                           dat['m_B(OH)3(mol/kgw)'], dat['m_H3BO3(mol/kgw)'])
+    pitzer_B = dat['m_B(OH)4-(mol/kgw)'] != 0
+    out['BOH4'] = np.where(pitzer_B,
+                           dat['m_B(OH)4-(mol/kgw)'] + dat['m_CaB(OH)4+(mol/kgw)'],
+                           dat['m_H2BO3-(mol/kgw)'] + dat['m_NaH2BO3(mol/kgw)'] + dat['m_CaH2BO3+(mol/kgw)'])
+    out['BOH4_free'] = np.where(pitzer_B,
+                                dat['m_B(OH)4-(mol/kgw)'], dat['m_H2BO3-(mol/kgw)'])
 
-def calc_cb_rows(df, dbase='pitzer', phreeq_path='/usr/local/lib/libiphreeqc.so'):
+    # auxillary data
+    out['pH'] = dat['pH']
+    out['temp'] = dat['temp(C)']
+    out['alk'] = dat['Alk(eq/kgw)']
+    out['SIc'] = dat['si_Calcite']
+    out['SIa'] = dat['si_Aragonite']
+    out['ion_str'] = dat['mu']
+
+    out['Ca'] = dat['Ca(mol/kgw)']
+    out['Na'] = dat['Na(mol/kgw)']
+    out['Cl'] = dat['Cl(mol/kgw)']
+    out['Mg'] = dat['Mg(mol/kgw)']
+    out['K'] = dat['K(mol/kgw)']
+    out['SO4'] = dat['S(6)(mol/kgw)']
+
+    return out.astype(np.float64)
+
+def _init_worker(dbase, phreeq_path):
+    """
+    Load the iphreeqc library and database once in each worker process.
+    """
+    get_phreeqc(dbase_file(dbase), phreeq_path)
+
+def _calc_batch(rows, dbase='pitzer', phreeq_path='/usr/local/lib/libiphreeqc.so'):
+    """
+    Calculate C and B chemistry of (temp, pH, Na, Cl, Ca, B, DIC, Mg) tuples in a single phreeqc run.
+
+    Returns
+    -------
+    pandas.DataFrame of summary data, with one row per input row.
+    """
+    inp = ''.join(input_str(temp=temp, pH=pH, Na=Na, Cl=Cl, Ca=Ca, B=B, DIC=DIC, Mg=Mg,
+                            n=n, selected_output=(n == 1))
+                  for n, (temp, pH, Na, Cl, Ca, B, DIC, Mg) in enumerate(rows, 1))
+    out = run_string(inp, dbase_file(dbase), phreeq_path)
+
+    if len(out) - 1 != len(rows):
+        raise ValueError('phreeqc returned {:d} rows of SELECTED_OUTPUT for {:d} solutions.'.format(len(out) - 1, len(rows)))
+
+    return summarise(pd.DataFrame(out[1:], columns=out[0]))
+
+def calc_cb_rows(df, dbase='pitzer', phreeq_path='/usr/local/lib/libiphreeqc.so', n_workers=None, batch_size=100):
     """
     Calculate solution conditions for each row of solution data.
 
@@ -161,34 +259,43 @@ def calc_cb_rows(df, dbase='pitzer', phreeq_path='/usr/local/lib/libiphreeqc.so'
     df : pandas.DataFrame
         Each row must contain ['Temp (°C)', 'pH (NBS)', '[Na M)',
         '[Cl M)', '[Ca M)', '[B M)', '[DIC M)', '[Mg M)]
+    n_workers : int
+        The maximum number of processes to run phreeqc in. If None, uses
+        os.cpu_count(). If 1, or if all rows fit in one batch, all rows
+        are calculated in this process.
+    batch_size : int
+        The maximum number of solutions calculated in each phreeqc run.
+        Rows are split into full batches of this size, and a process
+        pool is only used when there is more than one.
     
     Returns
     -------
     pandas.Dataframe with same index as input, with calculated C and B chemistry.
     """
-    # determine column names
-    r = df.iloc[0,:]
-    cols = calc_cb(temp=r['Temp (°C)'],
-                   pH=r['pH (NBS)'],
-                   Na=r['[Na] (M)'], 
-                   Cl=r['[Cl] (M)'], 
-                   Ca=r['[Ca] (M)'], 
-                   B=r['[B] (M)'], 
-                   DIC=r['[DIC] (M)'], 
-                   Mg=r['[Mg] (M)'], dbase=dbase).index
-
-    # create empty output dataframe
-    out = pd.DataFrame(index=df.index, columns=cols)
-    out.sort_index(1, inplace=True)
-    out.sort_index(0, inplace=True)
-    
-    for i, r in df.iterrows():
-        out.loc[i, :] = calc_cb(temp=r['Temp (°C)'],
-                                pH=r['pH (NBS)'],
-                                Na=r['[Na] (M)'], 
-                                Cl=r['[Cl] (M)'], 
-                                Ca=r['[Ca] (M)'], 
-                                B=r['[B] (M)'], 
-                                DIC=r['[DIC] (M)'], 
-                                Mg=r['[Mg] (M)'], dbase=dbase, phreeq_path=phreeq_path)
-    return out
+    incols = ['Temp (°C)', 'pH (NBS)', '[Na] (M)', '[Cl] (M)', '[Ca] (M)',
+              '[B] (M)', '[DIC] (M)', '[Mg] (M)']
+    rows = [tuple(r) for r in df.loc[:, incols].to_numpy(dtype=np.float64).tolist()]
+
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    # keep batches full: each worker process loads its own library and database,
+    # so the pool only pays off when there is more than one full batch.
+    batches = [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+
+    calc = partial(_calc_batch, dbase=dbase, phreeq_path=phreeq_path)
+    if n_workers == 1 or len(batches) == 1:
+        res = [calc(b) for b in batches]
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(batches)), initializer=_init_worker,
+                                 initargs=(dbase, phreeq_path)) as executor:
+            res = list(executor.map(calc, batches))
+
+    # every batch has the same summary columns, so fill a single float64 block
+    cols = res[0].columns
+    arr = np.empty((len(rows), len(cols)), dtype=np.float64)
+    for i, r in enumerate(res):
+        arr[i * batch_size:i * batch_size + len(r)] = r.loc[:, cols].to_numpy(dtype=np.float64)
+    out = pd.DataFrame(arr, index=df.index, columns=cols)
+
+    return sort_axes(out)
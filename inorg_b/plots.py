@@ -1,63 +1,116 @@
 import numpy as np
-from pandas import IndexSlice as idx
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 from .model import predfn
-from .helpers import extract_model_vars, err, nom
-
-def model_vs_data(params, rd, param_CIs=None, exp='Uchikawa', xvar=('Solid', 'logR'), Rvar=('Solid', 'logR')):
-
+from .helpers import extract_model_vars
+
+def model_vs_data(params, rd, param_CIs=None, exp='Uchikawa', xvar=('Solid', 'logR'), Rvar=('Solid', 'logR'), rasterized=False, axs=None, show_params=True):
+    """
+    Plot measured and modelled LambdaB and EpsilonB of an experiment, and their residuals.
+
+    Parameters
+    ----------
+    params : array-like
+        Model parameters, in the order (Kb3, Kf3, Kb4, Kf4, logRb).
+    rd : pandas.DataFrame
+        Data created by load.processed(). The index must be sorted, as
+        returned by processed(), for fast row lookups.
+    param_CIs : array-like
+        (lower, upper) confidence interval of each parameter, shown in the label.
+    rasterized : bool
+        If True, the data points and error bars are rasterized in vector output
+        (e.g. pdf), while axes and text stay as vectors. Only worthwhile for
+        large datasets; set a high dpi (e.g. 200) in savefig when using it.
+    axs : array of matplotlib.axes.Axes
+        2x2 axes returned by a previous call. If given, they are cleared and
+        redrawn, instead of creating a new figure. Use this when plotting
+        many experiments in a loop.
+    show_params : bool
+        If True, label the epsilon panel with the parameter values.
+
+    Returns
+    -------
+    fig, axs
+    """
+    if not rd.index.is_monotonic_increasing:
+        raise ValueError('rd must have a sorted index. Use rd.sort_index(), or load.processed().')
+
+    # look up the plotted rows once, and share them with extract_model_vars
+    sub = rd.xs((exp, 'Calcite'), level=(1, 2))
     (logRp, Rp, rL3, rL4, B_DIC, ABO3, ABO4, dBO4, LambdaB, EpsilonB, 
-     LambdaB_err, EpsilonB_err, LambdaB_err_norm, EpsilonB_err_norm) = extract_model_vars(rd, exp, Rvar)
+     LambdaB_err, EpsilonB_err, LambdaB_err_norm, EpsilonB_err_norm) = extract_model_vars(rd, exp, Rvar, sub=sub)
     
     if param_CIs is None:
-        param_CIs = np.full(params.shape, None)
-
-    cind = idx[:, exp, 'Calcite']
-
-    LambdaB_pred, EpsilonB_pred = predfn(*params, Rp, rL3, rL4, B_DIC, ABO3, ABO4, dBO4)
+        param_CIs = (None,) * len(params)
+
+    # plotted data in one (6, n) array, ordered so that each panel's data and
+    # model points are a contiguous, copy-free view: M[0:2] is x twice,
+    # M[2:4] is LambdaB then its prediction, M[4:6] is EpsilonB then its prediction.
+    M = np.empty((6, len(sub)))
+    M[0] = M[1] = sub[xvar].to_numpy()
+    M[2], M[4] = LambdaB, EpsilonB
+    M[3], M[5] = predfn(*params, Rp, rL3, rL4, B_DIC, ABO3, ABO4, dBO4)
+    x = M[0]
+    # LambdaB and EpsilonB are the same rows of rd as sub, so these serve both scatter and error bars
+    LambdaB_resid = M[3] - M[2]
+    EpsilonB_resid = M[5] - M[4]
+    # error bars: LambdaB_err and EpsilonB_err come from extract_model_vars
+    logR_err = sub[('Solid', 'logR_eprop')].to_numpy(dtype=np.float64)
     
-    fig, axs = plt.subplots(2, 2, figsize=[6, 4], sharex=True)
+    if axs is None:
+        fig, axs = plt.subplots(2, 2, figsize=[6, 4], layout='constrained')
+    else:
+        fig = axs[0, 0].figure
+        for ax in axs.flat:
+            ax.cla()
     ((ax1, rx1), (ax2, rx2)) = axs
 
     # plot options for all scatter points
     uni_opts = {'lw': 0.3,
                 'edgecolor': (0,0,0,0.7),
-                's': 20}
-
-    x = rd.loc[cind, xvar]
-
-    ax1.scatter(x,
-                LambdaB, **uni_opts, label='Data')
-    sc = ax1.scatter(x,
-                     LambdaB_pred, **uni_opts, label='Model')
+                's': 20,
+                'rasterized': rasterized}
+
+    # data and model in a single collection, coloured as two separate scatters would be,
+    # with empty proxy scatters for the legend
+    C0, C1 = plt.rcParams['axes.prop_cycle'].by_key()['color'][:2]
+    c = [C0] * len(x) + [C1] * len(x)
+    ax1.scatter(M[0:2].ravel(), M[2:4].ravel(),
+                c=c, **uni_opts)
+    for C, label in ((C0, 'Data'), (C1, 'Model')):
+        ax1.scatter([], [], color=C, **uni_opts, label=label)
     ax1.legend()
 
     rx1.scatter(x,
-                LambdaB_pred - LambdaB, c=(.6, .6, .6), **uni_opts)
-    rx1.errorbar(x,
-                 LambdaB_pred - rd.loc[cind, ('Solid', 'LambdaB')], 
-                 yerr=err(rd.loc[cind, ('Solid', 'LambdaB_eprop')]),
-                 xerr=err(rd.loc[cind, ('Solid', 'logR_eprop')]),
-                 color=(0,0,0,0.4), lw=0, elinewidth=1, label='_')
-
-    ax2.scatter(x,
-                EpsilonB, **uni_opts)
-    ax2.scatter(x,
-                EpsilonB_pred, **uni_opts)
+                LambdaB_resid, c=(.6, .6, .6), **uni_opts)
+    errorbars(rx1, x,
+              LambdaB_resid,
+              yerr=LambdaB_err, xerr=logR_err,
+              color=(0,0,0,0.4), lw=1, rasterized=rasterized)
+
+    ax2.scatter(M[0:2].ravel(), M[4:6].ravel(),
+                c=c, **uni_opts)
 
     rx2.scatter(x,
-                EpsilonB_pred - EpsilonB, c=(.6, .6, .6), **uni_opts)
-    rx2.errorbar(x,
-                 EpsilonB_pred - rd.loc[cind, ('Solid', 'EpsilonB')], 
-                 yerr=err(rd.loc[cind, ('Solid', 'EpsilonB_eprop')]),
-                 xerr=err(rd.loc[cind, ('Solid', 'logR_eprop')]),
-                 color=(0,0,0,0.4), lw=0, elinewidth=1)
+                EpsilonB_resid, c=(.6, .6, .6), **uni_opts)
+    errorbars(rx2, x,
+              EpsilonB_resid,
+              yerr=EpsilonB_err, xerr=logR_err,
+              color=(0,0,0,0.4), lw=1, rasterized=rasterized)
 
     for rx in [rx1, rx2]:
         rx.axhline(0, color=(0,0,0,0.4), ls='dashed', zorder=-1)
         rx.yaxis.tick_right()
         rx.yaxis.set_label_position('right')
 
+    # common x limits, set once instead of sharing the axes. The residual
+    # panels include the x error bars, so their limits cover all the others.
+    xlim = (min(ax.get_xlim()[0] for ax in axs.flat), max(ax.get_xlim()[1] for ax in axs.flat))
+    for ax in axs.flat:
+        ax.set_xlim(xlim)
+    for ax in (ax1, rx1):
+        ax.tick_params(labelbottom=False)
+
     # axis labels
     if xvar[-1] == 'logR':
         ax2.set_xlabel('$log_{10}R\ (mol\ m^{-2}\ s^{-1})$')
@@ -72,29 +125,46 @@ def model_vs_data(params, rd, param_CIs=None, exp='Uchikawa', xvar=('Solid', 'lo
     ax1.set_ylabel('$\lambda_B \\times 1000$', fontsize=12)
     ax2.set_ylabel('$\epsilon_{C-B}\ (\u2030_{NIST951})$', fontsize=12)
 
-    parlab = ('$log_{10}R_b$: ' + fmt(params[-1], 1, 1, param_CIs[-1]) + '\n' + 
-              '$^3K_f$: ' + fmt(params[1],2,8,param_CIs[1]) + '   $^3K_b$: ' + fmt(params[0],1,7,param_CIs[0]) + '\n' + 
-              '$^4K_f$: ' + fmt(params[3],2,8,param_CIs[3]) + '  $^4K_b$: ' + fmt(params[2],1,7,param_CIs[2]))
+    if show_params:
+        parlab = '\n'.join([f'$log_{{10}}R_b$: {fmt(params[-1], 1, 1, param_CIs[-1])}',
+                            f'$^3K_f$: {fmt(params[1], 2, 8, param_CIs[1])}   $^3K_b$: {fmt(params[0], 1, 7, param_CIs[0])}',
+                            f'$^4K_f$: {fmt(params[3], 2, 8, param_CIs[3])}  $^4K_b$: {fmt(params[2], 1, 7, param_CIs[2])}'])
+
+        # parlab = ('$log_{10}' + 'R_b$: {logRb:1.2f}\n'.format(logRb=params[-1]) + 
+        #           '$^3K_f$: {Kf3:6.2f}  $^3K_b$: {Kb3:.2f}\n'.format(Kf3=params[1],
+        #                                                              Kb3=params[0]) + 
+        #           '$^4K_f$: {Kf4:6.2f}  $^4K_b$: {Kb4:6.2f}'.format(Kf4=params[3],
+        #                                                             Kb4=params[2]))
 
-    # parlab = ('$log_{10}' + 'R_b$: {logRb:1.2f}\n'.format(logRb=params[-1]) + 
-    #           '$^3K_f$: {Kf3:6.2f}  $^3K_b$: {Kb3:.2f}\n'.format(Kf3=params[1],
-    #                                                              Kb3=params[0]) + 
-    #           '$^4K_f$: {Kf4:6.2f}  $^4K_b$: {Kb4:6.2f}'.format(Kf4=params[3],
-    #                                                             Kb4=params[2]))
+        ax2.text(.02, .02, parlab,
+                 transform=ax2.transAxes, ha='left', va='bottom', fontsize=7)
 
-    ax2.text(.02, .02, parlab,
-             transform=ax2.transAxes, ha='left', va='bottom', fontsize=7)
     ax1.text(.05, .5, '$\lambda_B = \\frac{B/Ca}{[B]/[DIC]}$',
              transform=ax1.transAxes, ha='left', va='bottom', fontsize=7)
 
-    fig.tight_layout()
-    
     return fig, axs
 
+def errorbars(ax, x, y, yerr, xerr, **kwargs):
+    """
+    Draw symmetric x and y error bars as a single LineCollection.
+
+    Equivalent to ax.errorbar(x, y, yerr, xerr, lw=0), without the
+    per-point artists.
+
+    Returns
+    -------
+    matplotlib.collections.LineCollection
+    """
+    yseg = np.stack([np.stack([x, y - yerr], -1), np.stack([x, y + yerr], -1)], 1)
+    xseg = np.stack([np.stack([x - xerr, y], -1), np.stack([x + xerr, y], -1)], 1)
+    lc = LineCollection(np.concatenate([yseg, xseg]), **kwargs)
+    ax.add_collection(lc)
+    ax.autoscale_view()
+    return lc
 
 def fmt(a, decimals=2, spc=0, ci=None):
-    fmt = '{:' + '{:.0f}'.format(spc) + '.' + '{:.0f}'.format(decimals) + 'f}'
+    spec = f'{spc:.0f}.{decimals:.0f}f'
     if ci is None:
-        return fmt.format(a)
+        return format(a, spec)
     else:
-        return '$' + fmt.format(a) + '_{' + fmt.format(ci[0]) + '}^{' + fmt.format(ci[1]) + '}$'
+        return f'${format(a, spec)}_{{{format(ci[0], spec)}}}^{{{format(ci[1], spec)}}}$'
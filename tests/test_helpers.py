@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from inorg_b.helpers import err, nom, sol_B_iso_Rae2018, sol_B_iso_Rae2018_err, d11_2_R11, R11_2_d11
+
+
+def _rae2018_reference(pH, BO4, BT, alpha, d11BT):
+    # original form of the Rae (2018) closed-form solution, with the full
+    # polynomial under the square root
+    R_BT = d11_2_R11(d11BT)
+    Hval = 10**(pH * -1)
+    Kbval = BO4 * Hval / (BT - BO4)
+    RB4 = (((Hval**2*R_BT**2 + 2*Hval**2*R_BT*alpha + Hval**2*alpha**2 + 2*Hval*Kbval*R_BT**2*alpha -
+             2*Hval*Kbval*R_BT*alpha**2 + 8*Hval*Kbval*R_BT*alpha - 2*Hval*Kbval*R_BT + 2*Hval*Kbval*alpha +
+             Kbval**2*R_BT**2*alpha**2 + 2*Kbval**2*R_BT*alpha + Kbval**2)**(1/2) -
+            Hval*alpha - Kbval + Hval*R_BT + Kbval*R_BT*alpha)/(2*alpha*(Hval + Kbval)))
+    RB3 = RB4 * alpha
+    return R11_2_d11(RB4), R11_2_d11(RB3)
+
+
+@pytest.fixture
+def solutions():
+    rng = np.random.default_rng(2018)
+    n = 500
+    BT = 10**rng.uniform(-4, -2, n)
+    return dict(pH=rng.uniform(7, 10, n),
+                BO4=BT * rng.uniform(0.02, 0.95, n),
+                BT=BT,
+                alpha=1.026,
+                d11BT=rng.uniform(-10, 60, n))
+
+
+def test_sol_B_iso_Rae2018(solutions):
+    d11BO4, d11BO3 = sol_B_iso_Rae2018(**solutions)
+    ref_BO4, ref_BO3 = _rae2018_reference(**solutions)
+
+    np.testing.assert_allclose(d11BO4, ref_BO4, rtol=1e-12, atol=1e-10)
+    np.testing.assert_allclose(d11BO3, ref_BO3, rtol=1e-12, atol=1e-10)
+
+
+def test_sol_B_iso_Rae2018_err(solutions):
+    up = pytest.importorskip('uncertainties.unumpy')
+
+    d11BT_err = np.random.default_rng(0).uniform(0.05, 1, solutions['d11BT'].size)
+    d11BO4_err, d11BO3_err = sol_B_iso_Rae2018_err(d11BT_err=d11BT_err, **solutions)
+
+    # first-order propagation of the d11BT uncertainty through the original expression
+    ref = dict(solutions, d11BT=up.uarray(solutions['d11BT'], d11BT_err))
+    ref_BO4, ref_BO3 = _rae2018_reference(**ref)
+
+    np.testing.assert_allclose(d11BO4_err, up.std_devs(ref_BO4), rtol=1e-10)
+    np.testing.assert_allclose(d11BO3_err, up.std_devs(ref_BO3), rtol=1e-10)
+
+
+def test_err_nom_uarray():
+    up = pytest.importorskip('uncertainties.unumpy')
+    x = up.uarray([1., 2., 3.], [0.1, 0.2, 0.3])
+
+    np.testing.assert_array_equal(err(x), [0.1, 0.2, 0.3])
+    np.testing.assert_array_equal(nom(x), [1., 2., 3.])
+
+
+def test_err_nom_eprop():
+    # '_eprop' columns hold uncertainties, however they are passed in
+    s = pd.Series([0.1, 0.2, 0.3], name=('Solid', 'LambdaB_eprop'))
+    for x in [s, s.values, s.to_numpy(), s.rename('renamed')]:
+        np.testing.assert_array_equal(err(x), [0.1, 0.2, 0.3])
+        with pytest.raises(TypeError):
+            nom(x)
+
+
+def test_err_nom_float_array():
+    x = np.array([0.1, 0.2, 0.3])
+
+    assert err(x).dtype == np.float64
+    np.testing.assert_array_equal(err(x), x)
+    with pytest.raises(TypeError):
+        nom(x)
@@ -0,0 +1,159 @@
+import numpy as np
+import pytest
+
+from inorg_b import model
+from inorg_b.helpers import A11_2_d11, d11_2_A11, d11_2_R11, R11_2_d11
+
+# original numpy forms of the model functions, which the compiled kernels replace
+
+def _rS_calc(Rb, Rp, Kf, rL, Kb):
+    return (Kf * rL * (Rp + Rb)) / (Rb * Kb + Rp)
+
+def _predfn(Kb3, Kf3, Kb4, Kf4, logRb, Rp, rL3, rL4, B_DIC, ABO3, ABO4, dBO4):
+    Rb = 10**logRb
+    rS4 = _rS_calc(Rb, Rp, Kf4, rL4, Kb4)
+    rS3 = _rS_calc(Rb, Rp, Kf3, rL3, Kb3)
+    rSB = rS3 + rS4
+    ABcal = (ABO3 * rS3 + ABO4 * rS4) / rSB
+    return rSB / B_DIC, A11_2_d11(ABcal) - dBO4
+
+def _predfn_single_species(Kb, Kf, logRb, epsilon, Rp, rL, B_DIC, dB, dBO4):
+    Rb = 10**logRb
+    rSB = _rS_calc(Rb, Rp, Kf, rL, Kb)
+    return rSB / B_DIC, dB + epsilon - dBO4
+
+def _predfn_single_species_R(Kb, Kf, alpha_eq, alpha_f, logRb, Rp, rL, B_DIC, dBO4):
+    Rb = 10**logRb
+    rSB = _rS_calc(Rb, Rp, Kf, rL, Kb)
+    alpha_solid = alpha_f / (1 + (Rb / (Rp + Rb)) * (alpha_f / alpha_eq - 1))
+    return rSB / B_DIC, R11_2_d11(d11_2_R11(dBO4) * alpha_solid) - dBO4
+
+def _predfn_BO4fractionated(Kb3, Kf3, Kb4, Kf4, logRb, eps4, Rp, rL3, rL4, B_DIC, dBO3, dBO4):
+    Rb = 10**logRb
+    rS4 = _rS_calc(Rb, Rp, Kf4, rL4, Kb4)
+    rS3 = _rS_calc(Rb, Rp, Kf3, rL3, Kb3)
+    rSB = rS3 + rS4
+    ABcal = (d11_2_A11(dBO3) * rS3 + d11_2_A11(dBO4 + eps4) * rS4) / rSB
+    return rSB / B_DIC, A11_2_d11(ABcal) - dBO4
+
+def _predfn_fractionated(Kb3, Kf3, Kb4, Kf4, logRb, eps3, eps4, Rp, rL3, rL4, B_DIC, dBO3, dBO4):
+    Rb = 10**logRb
+    rS4 = _rS_calc(Rb, Rp, Kf4, rL4, Kb4)
+    rS3 = _rS_calc(Rb, Rp, Kf3, rL3, Kb3)
+    rSB = rS3 + rS4
+    ABcal = (d11_2_A11(dBO3 + eps3) * rS3 + d11_2_A11(dBO4 + eps4) * rS4) / rSB
+    return rSB / B_DIC, A11_2_d11(ABcal) - dBO4
+
+def _fitfn(predfn, p, data, LambdaB, EpsilonB, LambdaB_err=1, EpsilonB_err=1, LambdaB_bias=None):
+    if LambdaB_bias is None:
+        LambdaB_bias = np.ptp(EpsilonB) / np.ptp(LambdaB)
+
+    LambdaB_calc, EpsilonB_calc = predfn(*p, *data)
+
+    Lam_err = LambdaB_bias * np.sum((LambdaB_calc - LambdaB)**2 / (LambdaB_err**2))
+    Eps_err = np.sum((EpsilonB_calc - EpsilonB)**2 / (EpsilonB_err**2))
+    return Lam_err / 2 + Eps_err / 2
+
+# name: (reference predfn, parameters, data variables)
+MODELS = {
+    '': (_predfn, (1800., 150., 2000., 250., -6.2),
+         ('Rp', 'rL3', 'rL4', 'B_DIC', 'ABO3', 'ABO4', 'dBO4')),
+    '_single_species': (_predfn_single_species, (2000., 200., -6.2, 0.5),
+                        ('Rp', 'rL4', 'B_DIC', 'dBO3', 'dBO4')),
+    '_single_species_R': (_predfn_single_species_R, (2000., 200., 1.01, 0.99, -6.2),
+                          ('Rp', 'rL4', 'B_DIC', 'dBO4')),
+    '_BO4fractionated': (_predfn_BO4fractionated, (1800., 150., 2000., 250., -6.2, 1.5),
+                         ('Rp', 'rL3', 'rL4', 'B_DIC', 'dBO3', 'dBO4')),
+    '_fractionated': (_predfn_fractionated, (1800., 150., 2000., 250., -6.2, -1., 1.5),
+                      ('Rp', 'rL3', 'rL4', 'B_DIC', 'dBO3', 'dBO4')),
+}
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(2018)
+    n = 60
+    dBO4 = rng.uniform(-20, 30, n)
+    return dict(Rp=10**rng.uniform(-7, -5, n),
+                rL3=10**rng.uniform(-5, -3, n),
+                rL4=10**rng.uniform(-5, -3, n),
+                B_DIC=rng.uniform(0.01, 1, n),
+                ABO3=d11_2_A11(dBO4 + 27),
+                ABO4=d11_2_A11(dBO4),
+                dBO3=dBO4 + 27,
+                dBO4=dBO4,
+                LambdaB_err=rng.uniform(0.1, 1, n),
+                EpsilonB_err=rng.uniform(0.1, 1, n))
+
+
+@pytest.fixture(params=[True, False], ids=['kernel', 'numpy'])
+def compiled(request, monkeypatch):
+    if request.param and not model.HAS_NUMBA:
+        pytest.skip('numba is not installed')
+    monkeypatch.setattr(model, 'HAS_NUMBA', request.param)
+    return request.param
+
+
+@pytest.mark.parametrize('name', MODELS)
+def test_predfn(name, data, compiled):
+    ref_predfn, p, variables = MODELS[name]
+    args = [data[v] for v in variables]
+
+    LambdaB, EpsilonB = getattr(model, 'predfn' + name)(*p, *args)
+    ref_LambdaB, ref_EpsilonB = ref_predfn(*p, *args)
+
+    np.testing.assert_allclose(LambdaB, ref_LambdaB, rtol=1e-12)
+    np.testing.assert_allclose(EpsilonB, ref_EpsilonB, rtol=1e-12, atol=1e-10)
+
+
+@pytest.mark.parametrize('weights', ['default', 'scalar', 'array', 'precomputed'])
+@pytest.mark.parametrize('name', MODELS)
+def test_fitfn(name, weights, data, compiled):
+    ref_predfn, p, variables = MODELS[name]
+    args = [data[v] for v in variables]
+
+    # observations near, but not at, the prediction for p
+    LambdaB, EpsilonB = ref_predfn(*[v * 1.1 for v in p], *args)
+
+    errs = {'default': {},
+            'scalar': dict(LambdaB_err=0.3, EpsilonB_err=0.7),
+            'array': dict(LambdaB_err=data['LambdaB_err'], EpsilonB_err=data['EpsilonB_err']),
+            'precomputed': dict(LambdaB_err=data['LambdaB_err'], EpsilonB_err=data['EpsilonB_err'])}[weights]
+    kwargs = dict(errs)
+    if weights == 'precomputed':
+        kwargs['LambdaB_w'], kwargs['EpsilonB_w'] = model.misfit_weights(**errs)
+        kwargs['LambdaB_bias'] = model.lambda_bias(LambdaB, EpsilonB)
+
+    misfit = getattr(model, 'fitfn' + name)(p, *args, LambdaB, EpsilonB, **kwargs)
+    ref_misfit = _fitfn(ref_predfn, p, args, LambdaB, EpsilonB, **errs)
+
+    np.testing.assert_allclose(misfit, ref_misfit, rtol=1e-10)
+
+
+@pytest.mark.parametrize('name', MODELS)
+def test_predfn_array_params(name, data, compiled):
+    # parameters broadcast against the data, as in the numpy functions
+    ref_predfn, p, variables = MODELS[name]
+    args = [data[v] for v in variables]
+    p = (np.array([[p[0]], [p[0] * 1.1]]),) + p[1:]
+
+    LambdaB, EpsilonB = getattr(model, 'predfn' + name)(*p, *args)
+    ref_LambdaB, ref_EpsilonB = ref_predfn(*p, *args)
+
+    assert LambdaB.shape == (2, data['Rp'].size)
+    assert EpsilonB.shape == np.shape(ref_EpsilonB)
+    np.testing.assert_allclose(LambdaB, ref_LambdaB, rtol=1e-12)
+    np.testing.assert_allclose(EpsilonB, ref_EpsilonB, rtol=1e-12, atol=1e-10)
+
+
+@pytest.mark.parametrize('name', MODELS)
+def test_predfn_scalar_inputs(name, data, compiled):
+    ref_predfn, p, variables = MODELS[name]
+    args = [data[v][0] for v in variables]
+
+    LambdaB, EpsilonB = getattr(model, 'predfn' + name)(*p, *args)
+    ref_LambdaB, ref_EpsilonB = ref_predfn(*p, *args)
+
+    assert np.ndim(LambdaB) == np.ndim(EpsilonB) == 0
+    assert isinstance(LambdaB, float) and isinstance(EpsilonB, float)
+    np.testing.assert_allclose([LambdaB, EpsilonB], [ref_LambdaB, ref_EpsilonB], rtol=1e-12)